@@ -1,9 +1,9 @@
 import os
+import sys
 import platform
-import PySimpleGUI as sg
 import json
 from concurrent.futures import ThreadPoolExecutor
-from . import anim
+from . import anim, cli
 
 
 def main():
@@ -11,6 +11,16 @@ def main():
     if platform.system() == 'Windows':
         os.environ['PATH'] += os.pathsep + os.path.join(os.path.dirname(__file__), 'bin')
 
+    # With a command (render, batch, ...) run headless, otherwise open the GUI
+    if len(sys.argv) > 1:
+        sys.exit(cli.main(sys.argv[1:]))
+    gui()
+
+
+def gui():
+    # Imported here so the headless commands don't need a display toolkit
+    import PySimpleGUI as sg
+
     win_width, win_height = 600, 150
 
     layout = [
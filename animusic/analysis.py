@@ -0,0 +1,219 @@
+import os
+import librosa
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from scipy.ndimage import median_filter
+from .signals import SignalTable
+from .telemetry import NULL_TELEMETRY
+
+
+VISUALIZER_BARS = 64
+
+
+def frame_parameters(sr, fps, frame_smoothing=3):
+    """Return the hop length, window length and FFT size matching the video fps."""
+    hop_length = int(np.round(sr/fps))
+    win_length = int(np.round(frame_smoothing*sr/fps))
+    n_fft = int(2**np.ceil(np.log2(win_length)))
+    return hop_length, win_length, n_fft
+
+
+def frame_times(duration, fps):
+    """Return the timestamps of the frames of a clip, without decoding it.
+
+    moviepy renders every clip on a constant frame rate grid (variable frame
+    rate videos are sampled at their average fps), so these are the same
+    times `clip.iter_frames(with_times=True)` goes through.
+    """
+    return np.arange(0, duration, 1.0/fps)
+
+
+def _odd(length):
+    return max(1, int(round(length)) // 2 * 2 + 1)
+
+
+def hpss_kernels(hop_length, n_fft):
+    """Return the (harmonic, percussive) median filter sizes in frames and bins.
+
+    They span the same time and frequency ranges as librosa's default 31x31
+    kernel does on its default STFT (hop length 512, FFT size 2048).
+    """
+    return _odd(31 * 512 / hop_length), _odd(31 * n_fft / 2048)
+
+
+def hpss_decimation(n_fft):
+    """Return how many adjacent bins percussive_mask pools for an FFT of size n_fft.
+
+    Pooling brings the spectrum down to the frequency resolution of
+    librosa's default STFT (FFT size 2048), which is all its median filters
+    need.
+    """
+    return max(1, n_fft // 2048)
+
+
+def stft_magnitude(y, n_fft, hop_length, win_length):
+    """Return the float32 magnitude spectrogram every analysis feature is derived from."""
+    D = librosa.stft(np.asarray(y, dtype=np.float32), n_fft=n_fft, hop_length=hop_length,
+                     win_length=win_length, window='blackman', dtype=np.complex64)
+    return np.abs(D)
+
+
+def percussive_mask(X, harmonic_size, percussive_size, margin=1, workers=None, band_size=64, decimation=1):
+    """Return the soft percussive mask of librosa's HPSS for the magnitude spectrogram X.
+
+    The median filters run directly on X instead of on the STFT of a
+    separate decomposition that has to be inverted. Each one is applied
+    to every bin or frame as a one-dimensional filter, which scipy does
+    much faster than a flat two-dimensional kernel, in parallel threads
+    over blocks of `band_size` of them.
+
+    harmonic_size: Length of the harmonic (time) filter in frames
+    percussive_size: Length of the percussive (frequency) filter in bins of X
+    workers: Number of threads, by default one per CPU
+    decimation: Number of adjacent bins averaged together before filtering,
+        see hpss_decimation. The mask is computed at that coarser resolution
+        and every bin of a group gets the mask of the group.
+    """
+    n_bins = X.shape[0]
+    if decimation > 1:
+        starts = np.arange(0, n_bins, decimation)
+        counts = np.diff(np.append(starts, n_bins)).astype(X.dtype)[:, None]
+        coarse = np.add.reduceat(X, starts, axis=0) / counts
+        mask = percussive_mask(coarse, harmonic_size, _odd(percussive_size / decimation), margin=margin,
+                               workers=workers, band_size=band_size)
+        return np.repeat(mask, decimation, axis=0)[:n_bins]
+
+    X = np.ascontiguousarray(X)
+    # Transposed, so the spectrum of every frame is a contiguous row
+    spectra = np.ascontiguousarray(X.T)
+    harmonic = np.empty_like(X)
+    percussive = np.empty_like(spectra)
+
+    def filter_rows(rows, out, size, start):
+        for k in range(start, min(start + band_size, len(rows))):
+            median_filter(rows[k], size=size, output=out[k])
+
+    with ThreadPoolExecutor(workers or os.cpu_count()) as executor:
+        jobs = [executor.submit(filter_rows, X, harmonic, harmonic_size, start)
+                for start in range(0, len(X), band_size)]
+        jobs += [executor.submit(filter_rows, spectra, percussive, percussive_size, start)
+                 for start in range(0, len(spectra), band_size)]
+        for job in jobs:
+            job.result()
+    return librosa.util.softmask(percussive.T, harmonic * margin, power=2)
+
+
+def windowed_nn_filter(S, horizon, k=None, block_size=1024):
+    """Nearest-neighbour filter of S with the neighbour search limited to a window.
+
+    Equivalent to librosa's nn_filter with an affinity, cosine-metric
+    recurrence matrix, except that the neighbours of each frame are only
+    looked for within `horizon` frames of it. Frames are processed in blocks,
+    so memory and time grow linearly with the number of frames instead of
+    quadratically.
+
+    S: Feature matrix of shape (n_features, n_frames)
+    horizon: Maximum distance in frames between a frame and its neighbours
+    k: Number of neighbours, by default librosa's 2 * ceil(sqrt(window - 1))
+    block_size: Number of frames whose neighbours are searched at once
+    """
+    if horizon < 1:
+        raise ValueError(f'The horizon must be at least 1 frame, got {horizon}')
+    n = S.shape[1]
+    if n < 2:
+        return S.copy()  # no other frames to filter with
+    window = min(n, 2 * horizon + 1)
+    if k is None:
+        k = int(2 * np.ceil(np.sqrt(window - 1)))
+    k = max(1, min(k, window - 1))
+
+    # Cosine distances are 1 - dot products of unit vectors
+    X = S.T.astype(np.float64)
+    norms = np.linalg.norm(X, axis=1, keepdims=True)
+    X /= np.where(norms > 0, norms, 1)
+
+    neighbors = np.empty((n, k), dtype=np.intp)
+    distances = np.empty((n, k))
+    for start in range(0, n, block_size):
+        end = min(start + block_size, n)
+        low, high = max(0, start - horizon), min(n, end + horizon)
+        d = 1 - X[start:end] @ X[low:high].T
+        offsets = np.arange(low, high)[None, :] - np.arange(start, end)[:, None]
+        d[(np.abs(offsets) > horizon) | (offsets == 0)] = np.inf
+        idx = np.argpartition(d, k - 1, axis=1)[:, :k]
+        neighbors[start:end] = idx + low
+        distances[start:end] = np.take_along_axis(d, idx, axis=1)
+
+    # Same scalar bandwidth as librosa: median distance to the k-th neighbour.
+    # Shifting each row by its smallest distance leaves the normalized weights
+    # unchanged but keeps them from all underflowing to zero.
+    np.maximum(distances, 0, out=distances)
+    bandwidth = np.median(distances.max(axis=1))
+    if bandwidth > 0:
+        weights = np.exp(-(distances - distances.min(axis=1, keepdims=True)) / bandwidth)
+    else:
+        weights = np.ones_like(distances)
+    weights /= weights.sum(axis=1, keepdims=True)
+
+    out = np.empty_like(S)
+    for start in range(0, n, block_size):
+        end = min(start + block_size, n)
+        out[:, start:end] = np.einsum('fbk,bk->fb', S[:, neighbors[start:end]], weights[start:end])
+    return out
+
+
+def analyze(y, sr, frame_times, fps, frame_smoothing=3, visualizer=False, horizon=None, telemetry=None):
+    """Return the effect signals for audio y and, optionally, the visualizer spectrogram.
+
+    The low and high bands are the two NMF activations of the filtered
+    percussive mel spectrogram, resampled to one value per video frame. The
+    percussive part is separated by median filtering a single float32 STFT,
+    pooled to librosa's default frequency resolution, and the visualizer
+    spectrogram is computed from the same STFT.
+
+    horizon: If set, only frames within this many seconds of each other are
+        compared when filtering the spectrogram, which keeps the analysis of
+        long tracks linear in their length. By default all frames are compared.
+    telemetry: Optional Telemetry timing every stage of the analysis
+
+    Returns a (SignalTable, spectrogram) pair; the spectrogram is None
+    unless `visualizer` is set.
+    """
+    hop_length, win_length, n_fft = frame_parameters(sr, fps, frame_smoothing)
+
+    telemetry = telemetry or NULL_TELEMETRY
+    # One STFT serves the separation and both mel spectrograms
+    with telemetry.stage('stft'):
+        X = stft_magnitude(y, n_fft, hop_length, win_length)
+    with telemetry.stage('hpss'):
+        mask = percussive_mask(X, *hpss_kernels(hop_length, n_fft), margin=1, decimation=hpss_decimation(n_fft))
+    with telemetry.stage('melspectrogram'):
+        S = librosa.filters.mel(sr=sr, n_fft=n_fft) @ (X * mask)
+#     S = librosa.decompose.nn_filter(S, aggregate=np.median)
+    with telemetry.stage('nn_filter'):
+        if horizon is None:
+            rec = librosa.segment.recurrence_matrix(S, mode='affinity', metric='cosine', sparse=True)
+            S = librosa.decompose.nn_filter(S, rec=rec, aggregate=np.average)
+        else:
+            S = windowed_nn_filter(S, horizon=int(np.ceil(horizon * sr / hop_length)))
+
+    with telemetry.stage('decompose'):
+        components, activations = librosa.decompose.decompose(S, n_components=2, sort=True)
+    # low, mid, high = activations
+    low, high = activations
+
+    # Frames of the centered STFT start at time 0
+    times = librosa.times_like(S, sr=sr, hop_length=hop_length)
+    signals = SignalTable.from_activations(times, frame_times, fps,
+        low=low,
+        # mid=mid,
+        high=high,
+    )
+
+    spectrogram = None
+    if visualizer:
+        with telemetry.stage('visualizer_spectrogram'):
+            spectrogram = librosa.filters.mel(sr=sr, n_fft=n_fft, n_mels=VISUALIZER_BARS) @ np.sqrt(X)
+            spectrogram = (spectrogram - spectrogram.min()) / (spectrogram.max() - spectrogram.min())
+
+    return signals, spectrogram
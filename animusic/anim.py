@@ -1,16 +1,16 @@
 import librosa
 import numpy as np
-import pandas as pd
 import os
-import matplotlib.pyplot as plt
-import PIL
 import mimetypes
-from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
-from matplotlib.figure import Figure
-from moviepy import editor
-from functools import partial
-from tqdm import tqdm
-from . import effects
+from moviepy.video.io.VideoFileClip import VideoFileClip
+from . import analysis, render
+from .pipeline import resolve_effects, scale_effects
+from .cache import AnalysisCache, hit_rate_report
+from .checkpoint import render_checkpointed
+from .telemetry import NULL_TELEMETRY, Telemetry
+from .audio import load_audio
+from .writer import output_scale
+from .visualizer import BarVisualizer
 
 
 def mins_to_secs(time_str):
@@ -25,7 +25,14 @@ def secs_to_mins(secs):
     return f'{mins:01d}:{secs:02d}'
 
 
-def draw_visualizer(S_frame, height=1000, width=1000, dpi=100):
+def draw_visualizer(S_frame, height=1000, width=1000, dpi=100, color='#ab20fd', style='native'):
+    if style == 'native':
+        return BarVisualizer(S_frame.shape[0], height, width, color=color, dpi=dpi).draw(S_frame)
+
+    # matplotlib is only needed for this style, so it's imported lazily
+    from matplotlib.backends.backend_agg import FigureCanvasAgg as FigureCanvas
+    from matplotlib.figure import Figure
+
     fig = Figure(figsize=(width/dpi, height/dpi), dpi=dpi)
     canvas = FigureCanvas(fig)
 
@@ -35,40 +42,23 @@ def draw_visualizer(S_frame, height=1000, width=1000, dpi=100):
     fig.patch.set_alpha(0)
 
     ax.set_ylim([0, 1])
-    ax.bar(np.arange(S_frame.shape[0]), S_frame*0.2, color='#ab20fd')
+    ax.bar(np.arange(S_frame.shape[0]), S_frame*0.2, color=color)
 
     canvas.draw()       # draw the canvas, cache the renderer
     s, (width, height) = canvas.print_to_buffer()
-    plt.close()
     
-    return np.fromstring(s, np.uint8).reshape((height, width, 4))
+    return np.frombuffer(s, np.uint8).reshape((height, width, 4)).copy()
 
 
-def apply_effect(get_frame, t, effect, signals, convert_image=False):
-        signal = signals.iloc[signals.index.get_loc(t ,method='nearest')]
-        
-        if signal == 0:
-            return get_frame(t)
-        else:
-            if convert_image:
-                return np.array(effect(PIL.Image.fromarray(get_frame(t), 'RGB'), signal=signal))
-            else:
-                return effect(get_frame(t), signal=signal)
-            
-            
-# def apply_effect(frame, t, effect, signals, convert_image=False):
-#         signal = signals.loc[t]
-        
-#         if signal == 0:
-#             return frame
-#         else:
-#             if convert_image:
-#                 return np.array(effect(Image.fromarray(frame, 'RGB'), signal=signal))
-#             else:
-#                 return effect(frame, signal=signal)
+def resolve_inputs(img=None, video=None, start_time=0, end_time=None, fps=30):
+    """Normalize the input arguments of an animation.
 
+    Times may be given as 'm:ss' strings, and a video passed as `img` is
+    treated as a video. For videos, the fps and end time are those of the
+    video itself.
 
-def create_animation(img=None, audio=None, video=None, output='animusic.mp4', start_time=0, end_time=None, fps=30, frame_smoothing=3, visualizer=False):
+    Returns (img, video, start_time, end_time, fps).
+    """
     if isinstance(start_time, str):
         start_time = mins_to_secs(start_time)
     if isinstance(end_time, str):
@@ -77,77 +67,111 @@ def create_animation(img=None, audio=None, video=None, output='animusic.mp4', st
     # global original_image
     # original_image = PIL.Image.open(img)
 
-    if mimetypes.guess_type(img)[0].startswith('video'):
+    if img and mimetypes.guess_type(img)[0].startswith('video'):
         video = img
         img = None
-    
-    print('Analyzing audio...')
-    if video and not audio:
-        y, sr = librosa.load(video, sr=None)
-    else:
-        y, sr = librosa.load(audio, sr=None)
-    
-    if end_time is None:
-        end_time = librosa.get_duration(y, sr)
-    duration = end_time - start_time
-    
+
     if video:
-        video_clip = editor.VideoFileClip(video)
+        video_clip = VideoFileClip(video, audio=False)
         fps = video_clip.fps
         end_time = start_time + video_clip.duration
-    else:
-        video_clip = editor.ImageClip(img, duration=duration).set_fps(fps)
+        video_clip.close()
+    return img, video, start_time, end_time, fps
 
-    y = y[int(start_time*sr):int(end_time*sr)]
-        
-    if audio:
-        audio_clip = editor.AudioFileClip(audio, fps=sr).subclip(t_start=start_time, t_end=end_time)
-        video_clip = video_clip.set_audio(audio_clip)
-    
-    frame_times = []
-    for t, frame in video_clip.iter_frames(with_times=True):
-        frame_times.append(t)
 
-    hop_length = int(np.round(sr/fps))
-    win_length = int(np.round(frame_smoothing*sr/fps))
-    n_fft = int(2**np.ceil(np.log2(win_length)))
-    
-    yh, yp = librosa.effects.hpss(y, margin=1)
-    S = librosa.feature.melspectrogram(yp, sr=sr, power=1, n_fft=n_fft, hop_length=hop_length, win_length=win_length, window='blackman', center=False)
-#     S = librosa.decompose.nn_filter(S, aggregate=np.median)
-    rec = librosa.segment.recurrence_matrix(S, mode='affinity', metric='cosine', sparse=True)
-    S = librosa.decompose.nn_filter(S, rec=rec, aggregate=np.average)
+def analyze_audio(source, start_time=0, end_time=None, fps=30, frame_smoothing=3, visualizer=False, analysis_cache=None, analysis_horizon=None, telemetry=None, samples=None):
+    """Return the effect signals of an audio file, reusing a cached analysis if possible.
+
+    telemetry: Optional Telemetry timing the decoding and the analysis stages
+    samples: Optional (y, sr) already decoded from the window by
+        audio.load_audio, analysed instead of decoding the window again
+
+    Returns (signals, spectrogram, end_time), with end_time resolved to the
+    end of the audio if it was None.
+    """
+    telemetry = telemetry or NULL_TELEMETRY
+    # Reuse a previous analysis of the same audio with the same parameters
+    result = None
+    if analysis_cache:
+        analysis_store = AnalysisCache(None if analysis_cache is True else analysis_cache)
+        key = analysis_store.key(source, start_time=start_time, end_time=end_time, fps=fps, frame_smoothing=frame_smoothing, horizon=analysis_horizon)
+        result = analysis_store.load(key)
+        if result is not None and visualizer and result[1] is None:
+            result = None
+        telemetry.cache('analysis', analysis_store.hits, analysis_store.misses)
+
+    if result is not None:
+        print(analysis_store.report())
+        signals, spectrogram, info = result
+        # Entries analysed with the visualizer also serve renders without it
+        if not visualizer:
+            spectrogram = None
+        return signals, spectrogram, float(info['end_time'])
+
+    if samples is None:
+        with telemetry.stage('audio_decode'):
+            samples = load_audio(source, start_time=start_time, end_time=end_time)
+    y, sr = samples
+    if end_time is None:
+        end_time = start_time + y.shape[-1] / sr
+    y = librosa.to_mono(y)
+
+    frame_times = analysis.frame_times(end_time - start_time, fps)
+    signals, spectrogram = analysis.analyze(y, sr, frame_times, fps, frame_smoothing=frame_smoothing, visualizer=visualizer, horizon=analysis_horizon, telemetry=telemetry)
+    if analysis_cache:
+        analysis_store.save(key, signals, spectrogram, sr=sr, end_time=end_time)
+    return signals, spectrogram, end_time
 
-    
-    components, activations = librosa.decompose.decompose(S, 2, sort=True)
-#     bin_idx = np.argsort(components, axis=0)[components.shape[0] // 2]
-#     activations = activations[np.argsort(bin_idx)]
-    # low, mid, high = activations
-    low, high = activations
-    
-    times = librosa.times_like(S, sr=sr, n_fft=n_fft, hop_length=hop_length)
-    signals = pd.DataFrame({
-        'low': low,
-        # 'mid': mid,
-        'high': high
-    }, index=times)
-#     signals = np.sqrt(signals)
-    signals = (signals - signals.min()) / (signals.max() - signals.min())
-#     signals /= signals.max()
-#     min_cutoff = 0.25
-#     max_cutoff = 0.45
-#     signals = signals.clip(min_cutoff, max_cutoff)
-#     signals = (signals - min_cutoff) / (max_cutoff - min_cutoff)
-        
-#     onset_env = librosa.onset.onset_strength(sr=sr, S=S)
-#     beats = librosa.onset.onset_detect(sr=sr, onset_envelope=onset_env, units='time')
-    signals = signals.reindex(frame_times, method='nearest')
-#     signals = signals.rolling(6, win_type='blackman', center=True).mean().fillna(0)
-#     signals = signals.clip(0)
-    # signals.plot()
-    # plt.show()
-    signals = (signals - signals.min()) / (signals.max() - signals.min())
-#     signals /= signals.max()
+
+def create_animation(img=None, audio=None, video=None, output='animusic.mp4', start_time=0, end_time=None, fps=30, frame_smoothing=3, visualizer=False, frame_cache=None, cache_step=0.01, workers=1, analysis_cache=None, analysis_horizon=None, codec='libx264', preset='medium', crf=None, pix_fmt=None, ffmpeg_params=None, effects=None, telemetry=None, profile=None, draft=False, draft_scale=0.25, draft_fps=15, draft_preset='ultrafast', checkpoint=None, segment_seconds=60):
+    """Render an audio-reactive animation of an image or video to `output`.
+
+    output: Path of the video, or a list of output specs to render several
+        versions (e.g. 16:9, square and vertical) from one analysis, one
+        decode and one pass of the effects. Each spec is a dict with the
+        path as 'output' and optionally 'aspect', 'width', 'height', 'fps'
+        and encoder options such as 'codec' or 'bitrate', see
+        writer.FanoutWriter. The effects are rendered at the lowest
+        resolution that still serves every output at full detail.
+    effects: Effect chain to apply, DEFAULT_EFFECTS by default. Either
+        (effect, band) pairs or a declarative spec mapping effect names to
+        bands and parameters, e.g. {'zoom': 'low', 'noise_bands':
+        {'band': 'high', 'mag': 8}}, see pipeline.parse_effects
+    telemetry: Optional Telemetry timing every stage of the analysis and the
+        rendering, see telemetry.Telemetry
+    profile: Path of a JSON file to write the telemetry report to
+    draft: Render a quick low-resolution preview instead. The frames are
+        resized by `draft_scale`, rendered at `draft_fps` and encoded with
+        `draft_preset`, with the effects scaled to look like the final
+        render. The audio is analysed at the final fps and cached (in the
+        default analysis cache unless one is given), so a final render with
+        the same settings and the analysis cache enabled skips the analysis.
+    checkpoint: Work directory that makes the render resumable. The analysis
+        is cached there (unless another analysis cache is given) and the
+        video is rendered in `segment_seconds` long segments recorded in a
+        manifest, so rerunning a killed render with the same arguments skips
+        the analysis and the finished segments, see checkpoint.render_checkpointed
+    """
+    if telemetry is None:
+        telemetry = Telemetry() if profile else NULL_TELEMETRY
+    img, video, start_time, end_time, fps = resolve_inputs(img, video, start_time, end_time, fps)
+    effects = resolve_effects(effects)
+    if draft:
+        analysis_cache = analysis_cache or True
+    if checkpoint and not analysis_cache:
+        analysis_cache = os.path.join(checkpoint, 'analysis')
+
+    print('Analyzing audio...')
+    source = video if video and not audio else audio
+    with telemetry.stage('analysis'):
+        # Decode the window of the audio track once, for both the analysis and
+        # muxing. Segmented renders mux it while joining the segments, where
+        # ffmpeg decodes it from the file instead.
+        samples = None
+        if audio and workers <= 1 and not checkpoint:
+            with telemetry.stage('audio_decode'):
+                samples = load_audio(audio, start_time=start_time, end_time=end_time)
+        signals, spectrogram, end_time = analyze_audio(source, start_time=start_time, end_time=end_time, fps=fps, frame_smoothing=frame_smoothing, visualizer=visualizer, analysis_cache=analysis_cache, analysis_horizon=analysis_horizon, telemetry=telemetry, samples=samples)
 
 #     original_image = np.array(Image.open(img).convert('RGB'))
 #     frames = []
@@ -174,45 +198,83 @@ def create_animation(img=None, audio=None, video=None, output='animusic.mp4', st
 #     video_clip = video_clip.set_audio(audio_clip)
         
 #     Effects
-    video_clip = (video_clip
-        .fl(partial(
-            apply_effect,
-            effect=effects.chromatic_aberration,
-            signals=signals.high,
-        ))
-        .fl(partial(
-            apply_effect,
-            effect=effects.sin_wave_distortion,
-            signals=signals.high,
-        ))
-        .fl(partial(
-            apply_effect,
-            effect=effects.zoom,
-            signals=signals.low,
-        ))
-    )
-    
-    if visualizer:
-        print('Drawing visualizer...')
-
-        bars = 64
-        S = librosa.feature.melspectrogram(y, sr=sr, power=0.5, n_mels=bars, n_fft=n_fft, hop_length=hop_length, win_length=win_length, window='blackman')
-        S = (S - S.min()) / (S.max() - S.min())
+    scale = 1
+    if draft:
+        # Same signals and visualizer at a lower frame rate, effects scaled down with the frames
+        draft_fps = min(draft_fps, fps)
+        frames = signals.resample_indices(draft_fps)
+        signals = signals.resample(draft_fps)
+        if spectrogram is not None:
+            spectrogram = spectrogram[:, np.minimum(frames, spectrogram.shape[1] - 1)]
+        effects = scale_effects(effects, draft_scale)
+        scale = draft_scale
+        preset = draft_preset
+        if not isinstance(output, str):
+            # Outputs of drafts keep the draft's resolution and frame rate
+            output = [dict(spec, width=None, height=None, fps=None) for spec in output]
+    elif not isinstance(output, str):
+        # No output needs more detail than its largest one, so skip rendering the rest
+        size = render.source_size(img, video)
+        scale = min(1, max(output_scale(size, spec) for spec in output))
+        if scale < 1:
+            effects = scale_effects(effects, scale)
 
-        visualizer_frames = []
-        for S_frame in tqdm(S.T):
-            frame = draw_visualizer(S_frame, height=video_clip.h, width=video_clip.w)
-            visualizer_frames.append(frame)
+    encoder = dict(codec=codec, preset=preset, crf=crf, pix_fmt=pix_fmt, ffmpeg_params=ffmpeg_params)
+    if checkpoint:
+        print(f'Rendering video in segments to {checkpoint}...')
+        with telemetry.stage('render'):
+            render_checkpointed(output, signals, checkpoint,
+                                segment_seconds=segment_seconds,
+                                workers=workers,
+                                img=img,
+                                video=video,
+                                spectrogram=spectrogram,
+                                audio=audio or video,
+                                audio_start=start_time if audio else 0,
+                                frame_cache=frame_cache,
+                                cache_step=cache_step,
+                                effects=effects,
+                                telemetry=telemetry,
+                                scale=scale,
+                                **encoder
+                               )
+    elif workers > 1:
+        print(f'Rendering video in {workers} processes...')
+        with telemetry.stage('render'):
+            render.render_parallel(output, signals, workers,
+                                   img=img,
+                                   video=video,
+                                   spectrogram=spectrogram,
+                                   audio=audio or video,
+                                   audio_start=start_time if audio else 0,
+                                   frame_cache=frame_cache,
+                                   cache_step=cache_step,
+                                   effects=effects,
+                                   telemetry=telemetry,
+                                   scale=scale,
+                                   **encoder
+                                  )
+    else:
+        # Effects are applied by a few threads while ffmpeg encodes with the rest
+        print('Rendering video...')
+        with telemetry.stage('render'):
+            stats = render.render_segment(output, 0, len(signals), signals,
+                                          img=img,
+                                          video=video,
+                                          spectrogram=spectrogram,
+                                          frame_cache=frame_cache,
+                                          cache_step=cache_step,
+                                          effects=effects,
+                                          telemetry=telemetry,
+                                          scale=scale,
+                                          audio=None if samples is not None else video,
+                                          audio_samples=samples,
+                                          render_threads=max(1, (os.cpu_count() or 1) // 2),
+                                          **encoder
+                                         )
+        # Frames of a still image only depend on the signals, so they were cached
+        if stats is not None:
+            print(hit_rate_report('Frame cache', *stats))
 
-        visualizer_clip = editor.ImageSequenceClip(visualizer_frames, fps=fps)
-        video_clip = editor.CompositeVideoClip([video_clip, visualizer_clip])
-    
-    print('Rendering video...')
-    # video_clip.preview()
-    video_clip.write_videofile(output,
-                               audio_codec='aac',
-                               threads=os.cpu_count(),
-                               preset='medium',
-#                                preset='veryslow',
-                               ffmpeg_params=['-bf', '2', '-b_strategy', '2']
-                              )
+    if profile:
+        telemetry.save(profile)
@@ -0,0 +1,45 @@
+import subprocess
+import numpy as np
+import soundfile
+from moviepy.config import get_setting
+from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+
+
+def _decode_with_ffmpeg(path, start_time=0, duration=None, channels=2):
+    """Decode an audio window with ffmpeg, for formats libsndfile can't read (e.g. video files)."""
+    infos = ffmpeg_parse_infos(path)
+    if not infos.get('audio_found'):
+        raise IOError(f'No audio stream found in {path}')
+    sr = infos['audio_fps']
+
+    cmd = [get_setting('FFMPEG_BINARY'), '-ss', str(start_time), '-i', path]
+    if duration is not None:
+        cmd += ['-t', str(duration)]
+    cmd += ['-vn', '-f', 'f32le', '-acodec', 'pcm_f32le', '-ac', str(channels), '-ar', str(sr), '-']
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if proc.returncode:
+        raise IOError(proc.stderr.decode('utf8'))
+    return np.frombuffer(proc.stdout, np.float32).reshape(-1, channels).T, sr
+
+
+def load_audio(path, start_time=0, end_time=None):
+    """Decode the [start_time, end_time] window of an audio file as float32.
+
+    Only the requested window is decoded: libsndfile seeks straight to
+    `start_time`, and ffmpeg (used for anything libsndfile can't read) is
+    given the window as input options. The channels are kept so the same
+    decode can be muxed into the video; use librosa.to_mono for analysis.
+
+    Returns (y, sr) with y of shape (n_channels, n_samples).
+    """
+    duration = None if end_time is None else end_time - start_time
+    try:
+        with soundfile.SoundFile(path) as f:
+            sr = f.samplerate
+            f.seek(min(int(np.round(start_time * sr)), f.frames))
+            frames = -1 if duration is None else int(np.round(duration * sr))
+            y = f.read(frames, dtype='float32', always_2d=True).T
+    except RuntimeError:  # soundfile.LibsndfileError, or RuntimeError on older versions
+        y, sr = _decode_with_ffmpeg(path, start_time, duration)
+    return np.ascontiguousarray(y), sr
+
@@ -0,0 +1,212 @@
+import json
+import os
+import platform
+import statistics
+import tempfile
+import time
+import librosa
+import numpy as np
+import soundfile
+from PIL import Image
+from . import analysis
+from .audio import load_audio
+from .pipeline import EFFECTS, EffectChain, DEFAULT_EFFECTS
+from .render import render_segment
+from .signals import SignalTable
+from .visualizer import BarVisualizer
+
+
+# Frame sizes the per-frame benchmarks run at, as (height, width)
+RESOLUTIONS = {
+    '720p': (720, 1280),
+    '1080p': (1080, 1920),
+    '4k': (2160, 3840),
+}
+
+
+def synth_audio(duration=30, sr=22050, seed=0):
+    """Return a stereo test track as (y, sr): a chord, a kick drum and hi-hat noise.
+
+    The kick and the hats alternate so the analysis finds distinct low and
+    high activations, like in real music.
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(duration * sr)) / sr
+    y = 0.1 * sum(np.sin(2 * np.pi * f * t) for f in (220, 277.2, 329.6))
+    beat = t % 0.5
+    y += 0.8 * np.sin(2 * np.pi * 60 * beat) * np.exp(-beat * 20)
+    offbeat = (t + 0.25) % 0.5
+    y += 0.3 * rng.standard_normal(len(t)) * np.exp(-offbeat * 60)
+    y = np.stack([y, np.roll(y, 7)]) / np.abs(y).max()
+    return y.astype(np.float32), sr
+
+
+def synth_image(height, width, seed=0):
+    """Return an RGB uint8 test image: colour gradients with noise on top."""
+    rng = np.random.default_rng(seed)
+    ys, xs = np.mgrid[0:height, 0:width]
+    image = np.stack([xs / width, ys / height, (xs + ys) / (width + height)], axis=-1) * 200
+    image += rng.integers(0, 56, size=image.shape)
+    return image.astype(np.uint8)
+
+
+def synth_signals(n_frames, fps=30, seed=0):
+    """Return a SignalTable of random signals for every band of the default chain."""
+    rng = np.random.default_rng(seed)
+    bands = dict.fromkeys(band for _, band in DEFAULT_EFFECTS)
+    return SignalTable(fps, **{band: rng.random(n_frames) for band in bands})
+
+
+def measure(function, repeat=5, warmup=1, number=1):
+    """Time `function` and return the statistics of the seconds per call.
+
+    number: Calls per timing, for functions too fast to time one by one
+    """
+    for _ in range(warmup):
+        function()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        times.append((time.perf_counter() - start) / number)
+    return {
+        'repeat': repeat,
+        'number': number,
+        'min': min(times),
+        'median': statistics.median(times),
+        'mean': statistics.mean(times),
+    }
+
+
+def effect_benchmarks(resolutions, signal=0.7):
+    """Yield (name, function) pairs timing every chain effect and the visualizer."""
+    for label, (height, width) in resolutions.items():
+        frame = synth_image(height, width)
+        out = np.empty_like(frame)
+        for name, effect in EFFECTS.items():
+            yield f'effects.{name}[{label}]', lambda effect=effect, frame=frame, out=out: effect(frame, signal=signal, out=out)
+
+        chain = EffectChain(DEFAULT_EFFECTS, synth_signals(1))
+        yield f'chain[{label}]', lambda chain=chain, frame=frame: chain.apply(frame, 0)
+
+        S = np.random.default_rng(0).random(analysis.VISUALIZER_BARS)
+        visualizer = BarVisualizer(len(S), height, width)
+        yield f'draw_visualizer[{label}]', lambda visualizer=visualizer, S=S: visualizer.draw(S)
+        yield f'composite_visualizer[{label}]', lambda visualizer=visualizer, S=S, frame=frame.copy(): visualizer.composite(frame, S)
+
+
+def analysis_benchmarks(path, fps=30, frame_smoothing=3):
+    """Yield (name, function) pairs timing every stage of the audio analysis of `path`."""
+    y, sr = load_audio(path)
+    y = librosa.to_mono(y)
+    hop_length, win_length, n_fft = analysis.frame_parameters(sr, fps, frame_smoothing)
+    kernels = analysis.hpss_kernels(hop_length, n_fft)
+    decimation = analysis.hpss_decimation(n_fft)
+    mel_basis = librosa.filters.mel(sr=sr, n_fft=n_fft)
+    X = analysis.stft_magnitude(y, n_fft, hop_length, win_length)
+    Xp = X * analysis.percussive_mask(X, *kernels, decimation=decimation)
+    S = mel_basis @ Xp
+
+    def nn_filter():
+        rec = librosa.segment.recurrence_matrix(S, mode='affinity', metric='cosine', sparse=True)
+        return librosa.decompose.nn_filter(S, rec=rec, aggregate=np.average)
+
+    frame_times = analysis.frame_times(len(y) / sr, fps)
+    yield 'analysis.decode', lambda: load_audio(path)
+    yield 'analysis.stft', lambda: analysis.stft_magnitude(y, n_fft, hop_length, win_length)
+    yield 'analysis.hpss', lambda: analysis.percussive_mask(X, *kernels, decimation=decimation)
+    yield 'analysis.hpss_single_thread', lambda: analysis.percussive_mask(X, *kernels, workers=1,
+                                                                          decimation=decimation)
+    yield 'analysis.melspectrogram', lambda: mel_basis @ Xp
+    yield 'analysis.nn_filter', nn_filter
+    yield 'analysis.windowed_nn_filter', lambda: analysis.windowed_nn_filter(S, horizon=int(np.ceil(10 * sr / hop_length)))
+    yield 'analysis.decompose', lambda: librosa.decompose.decompose(S, n_components=2, sort=True)
+    yield 'analysis.total', lambda: analysis.analyze(y, sr, frame_times, fps, frame_smoothing=frame_smoothing)
+    yield 'analysis.total_visualizer', lambda: analysis.analyze(y, sr, frame_times, fps, frame_smoothing=frame_smoothing, visualizer=True)
+
+
+def render_benchmarks(directory, resolutions, n_frames=90, fps=30):
+    """Yield (name, function, n_frames) triples timing end-to-end renders of a still image."""
+    for label, (height, width) in resolutions.items():
+        img = os.path.join(directory, f'{label}.png')
+        Image.fromarray(synth_image(height, width)).save(img)
+        signals = synth_signals(n_frames, fps)
+        output = os.path.join(directory, f'{label}.mp4')
+        yield f'render[{label}]', lambda img=img, signals=signals, output=output: render_segment(
+            output, 0, n_frames, signals, img=img, render_threads=max(1, (os.cpu_count() or 1) // 2)), n_frames
+
+
+def environment():
+    import moviepy
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'numpy': np.__version__,
+        'librosa': librosa.__version__,
+        'moviepy': moviepy.__version__,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def run(quick=False, select=None, repeat=5, log=print):
+    """Run the benchmarks and return the results as a JSON-serializable dict.
+
+    Everything runs on generated fixtures, so no files or network are needed.
+
+    quick: Only use 720p frames and a short track, for smoke tests
+    select: Only run the benchmarks whose name contains this string
+    repeat: Number of timed runs of every benchmark
+    log: Called with a line of text after every benchmark
+    """
+    resolutions = {'720p': RESOLUTIONS['720p']} if quick else RESOLUTIONS
+    results = {}
+
+    def record(name, function, n_frames=None, repeat=repeat, number=1):
+        if select and select not in name:
+            return
+        result = measure(function, repeat=repeat, number=number)
+        if n_frames:
+            result['fps'] = n_frames / result['median']
+        results[name] = result
+        log(f"{name:40s} {result['median'] * 1000:10.2f} ms" + (f"  ({result['fps']:.1f} frames/s)" if n_frames else ''))
+
+    for name, function in effect_benchmarks(resolutions):
+        record(name, function, number=5)
+
+    with tempfile.TemporaryDirectory() as directory:
+        y, sr = synth_audio(duration=10 if quick else 60)
+        path = os.path.join(directory, 'track.wav')
+        soundfile.write(path, y.T, sr)
+        for name, function in analysis_benchmarks(path):
+            record(name, function, repeat=min(repeat, 3))
+        for name, function, n_frames in render_benchmarks(directory, resolutions, n_frames=30 if quick else 90):
+            record(name, function, n_frames=n_frames, repeat=min(repeat, 3))
+
+    return {'environment': environment(), 'results': results}
+
+
+def compare(baseline, current, threshold=0.1):
+    """Return the benchmarks of `current` that are slower than in `baseline`.
+
+    A benchmark regressed when its median time grew by more than `threshold`
+    (a fraction). Returns a list of (name, baseline_seconds, current_seconds).
+    """
+    regressions = []
+    for name, result in current['results'].items():
+        reference = baseline['results'].get(name)
+        if reference and result['median'] > reference['median'] * (1 + threshold):
+            regressions.append((name, reference['median'], result['median']))
+    return regressions
+
+
+def save(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
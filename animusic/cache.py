@@ -0,0 +1,173 @@
+import hashlib
+import json
+import os
+import threading
+import numpy as np
+from collections import OrderedDict
+from .signals import SignalTable
+
+
+def hit_rate_report(name, hits, misses):
+    lookups = hits + misses
+    rate = hits / lookups if lookups else 0.0
+    return f'{name}: {hits} hits, {misses} misses ({rate:.1%} hit rate)'
+
+
+class FrameCache:
+    """LRU cache of rendered frames keyed on quantized signal values.
+
+    Only valid when the source frame never changes (e.g. a still image), so
+    that a rendered frame depends on nothing but its signals.
+
+    max_bytes: Memory budget for the cached frames
+    step: Quantization step applied to the signals before they are used as a key
+    """
+
+    def __init__(self, max_bytes, step=0.01):
+        self.max_bytes = max_bytes
+        self.step = step
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._frames = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, values):
+        """Return the cache key for a sequence of signal values."""
+        return tuple(int(round(value / self.step)) for value in values)
+
+    def values(self, key):
+        """Return the quantized signal values a key stands for."""
+        return [k * self.step for k in key]
+
+    def get(self, key):
+        with self._lock:
+            frame = self._frames.get(key)
+            if frame is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._frames.move_to_end(key)
+            return frame
+
+    def put(self, key, frame):
+        """Store a read-only copy of `frame` and return it."""
+        frame = frame.copy()
+        frame.flags.writeable = False
+        if frame.nbytes > self.max_bytes:
+            return frame
+        with self._lock:
+            if key in self._frames:
+                self.nbytes -= self._frames.pop(key).nbytes
+            self._frames[key] = frame
+            self.nbytes += frame.nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._frames.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+        return frame
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def report(self):
+        return (hit_rate_report('Frame cache', self.hits, self.misses)
+                + f', {len(self._frames)} frames cached')
+
+
+def default_cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'animusic', 'analysis')
+
+
+def file_digest(path, chunk_size=2**20):
+    """Return the SHA-256 hex digest of a file's contents."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class AnalysisCache:
+    """Content-addressed on-disk cache of audio analysis results.
+
+    Every entry is an .npz file holding the per-frame signals, the optional
+    visualizer spectrogram and a few scalars. When the directory grows past
+    `max_bytes`, the least recently used entries are deleted.
+
+    directory: Where entries are stored (defaults to ~/.cache/animusic/analysis)
+    max_bytes: Size limit of the directory
+    """
+
+    # Bump when the analysis changes so stale entries are no longer used
+    version = 3
+
+    def __init__(self, directory=None, max_bytes=2**30):
+        self.directory = directory or default_cache_dir()
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, audio_path, **params):
+        """Return the key for analysing `audio_path` with the given parameters."""
+        params = dict(params, audio=file_digest(audio_path), version=self.version)
+        return hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def load(self, key):
+        """Return (signals, spectrogram, info) for a key, or None on a miss.
+
+        info holds the scalars stored with the entry.
+        """
+        path = self.path(key)
+        try:
+            with np.load(path) as data:
+                arrays = {name: data[name] for name in data.files}
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        os.utime(path)  # mark as recently used
+        self.hits += 1
+
+        bands = {name[len('band_'):]: arrays.pop(name) for name in list(arrays) if name.startswith('band_')}
+        signals = SignalTable(arrays.pop('fps').item(), **bands)
+        spectrogram = arrays.pop('spectrogram', None)
+        return signals, spectrogram, {name: value.item() for name, value in arrays.items()}
+
+    def save(self, key, signals, spectrogram=None, **info):
+        arrays = {'band_' + name: values for name, values in signals.bands.items()}
+        if spectrogram is not None:
+            arrays['spectrogram'] = spectrogram.astype(np.float32)
+        # Write to a temporary file first so readers never see a partial entry
+        tmp_path = self.path(key) + f'.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez_compressed(f, fps=signals.fps, **arrays, **info)
+        os.replace(tmp_path, self.path(key))
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        """Delete least recently used entries until the cache fits in max_bytes.
+
+        keep: Key of an entry that must not be deleted
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.npz'):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if name == f'{keep}.npz':
+                continue
+            os.remove(os.path.join(self.directory, name))
+            total -= size
+
+    def report(self):
+        return hit_rate_report('Analysis cache', self.hits, self.misses)
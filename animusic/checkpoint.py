@@ -0,0 +1,167 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from .cache import file_digest, hit_rate_report
+from .pipeline import DEFAULT_EFFECTS, effect_function, effect_name, effect_parameters
+from .render import _render_profiled_segment, concat_segments, render_segment
+from .telemetry import NULL_TELEMETRY
+
+
+def fixed_segments(n_frames, length):
+    """Split range(n_frames) into contiguous (start, end) ranges of `length` frames."""
+    return [(start, min(start + length, n_frames)) for start in range(0, n_frames, length)]
+
+
+def effect_description(effect):
+    """Return a JSON-serializable description of an effect, including parameters bound with functools.partial."""
+    function = effect_function(effect)
+    return [f'{getattr(function, "__module__", "")}.{effect_name(effect)}', effect_parameters(effect)]
+
+
+def render_fingerprint(specs, signals, img=None, video=None, spectrogram=None, effects=None, scale=1, **options):
+    """Return a digest of everything the rendered segments depend on.
+
+    The output paths are left out: segments can be assembled anywhere.
+    """
+    digest = hashlib.sha256()
+    for name in sorted(signals.bands):
+        digest.update(name.encode())
+        digest.update(signals.bands[name].tobytes())
+    if spectrogram is not None:
+        digest.update(spectrogram.tobytes())
+    params = {
+        'source': file_digest(video or img),
+        'signals': digest.hexdigest(),
+        'fps': signals.fps,
+        'effects': [[effect_description(effect), band] for effect, band in effects or DEFAULT_EFFECTS],
+        'outputs': [{key: value for key, value in spec.items() if key != 'output'} for spec in specs],
+        'scale': scale,
+        **options,
+    }
+    return hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class RenderManifest:
+    """Progress of a checkpointed render, kept as JSON in its work directory.
+
+    A manifest written by a render with a different fingerprint or
+    segmentation is ignored, so changed parameters start over.
+
+    work_dir: Work directory of the render
+    fingerprint: Digest of the render parameters, see render_fingerprint
+    segments: List of the (start, end) frame ranges of the segments
+    """
+
+    def __init__(self, work_dir, fingerprint, segments):
+        self.path = os.path.join(work_dir, 'manifest.json')
+        self.fingerprint = fingerprint
+        self.segments = [list(segment) for segment in segments]
+        self.completed = set()
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get('fingerprint') == fingerprint and data.get('segments') == self.segments:
+            self.completed = set(data['completed'])
+        else:
+            print('Render parameters changed, discarding the previous segments')
+
+    def complete(self, index):
+        """Record segment `index` as finished."""
+        self.completed.add(index)
+        self.save()
+
+    def save(self):
+        data = {'fingerprint': self.fingerprint, 'segments': self.segments, 'completed': sorted(self.completed)}
+        # Write to a temporary file first so a kill never leaves a partial manifest
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        os.remove(self.path)
+
+
+def render_checkpointed(output, signals, work_dir, segment_seconds=60, workers=1, img=None, video=None,
+                        spectrogram=None, audio=None, audio_start=0, frame_cache=None, cache_step=0.01,
+                        effects=None, telemetry=None, scale=1, **encoder):
+    """Render the animation in fixed-length segments that survive the process being killed.
+
+    Every finished segment is recorded in a manifest in `work_dir`, so
+    running the same render again only renders the segments that are
+    missing. Once all are done, they are concatenated losslessly with the
+    audio muxed in, and the segments and manifest are deleted.
+
+    output: Path of the video, or a list of output specs (see FanoutWriter)
+    work_dir: Directory holding the segments and the manifest
+    segment_seconds: Length of the segments, i.e. the most work lost by a kill
+    workers: Number of processes rendering segments at the same time
+    Other arguments are those of render_parallel.
+    """
+    telemetry = telemetry or NULL_TELEMETRY
+    specs = [{'output': output}] if isinstance(output, str) else output
+    segment_dir = os.path.join(work_dir, 'segments')
+    os.makedirs(segment_dir, exist_ok=True)
+
+    segments = fixed_segments(len(signals), max(1, int(round(segment_seconds * signals.fps))))
+    fingerprint = render_fingerprint(specs, signals, img=img, video=video, spectrogram=spectrogram,
+                                     effects=effects, scale=scale, frame_cache=frame_cache is not None,
+                                     cache_step=cache_step, **encoder)
+    manifest = RenderManifest(work_dir, fingerprint, segments)
+    parts = [
+        [dict(spec, output=os.path.join(segment_dir, f'segment{k:04d}-{j}.mp4')) for j, spec in enumerate(specs)]
+        for k in range(len(segments))
+    ]
+    pending = [k for k in range(len(segments))
+               if k not in manifest.completed or not all(os.path.exists(part['output']) for part in parts[k])]
+    if len(pending) < len(segments):
+        print(f'Resuming: {len(segments) - len(pending)}/{len(segments)} segments already rendered')
+
+    def arguments(k):
+        start, end = segments[k]
+        part = parts[k][0]['output'] if isinstance(output, str) else parts[k]
+        options = dict(img=img, video=video, spectrogram=spectrogram, frame_cache=frame_cache,
+                       cache_step=cache_step, effects=effects, scale=scale, **encoder)
+        return (part, start, end, signals), options
+
+    stats = []
+    if workers > 1:
+        threads = max(1, (os.cpu_count() or 1) // workers)
+        # Workers time into their own Telemetry and send back what it recorded
+        target = _render_profiled_segment if telemetry.enabled else render_segment
+        with ProcessPoolExecutor(workers) as executor:
+            futures = {}
+            for k in pending:
+                args, options = arguments(k)
+                futures[executor.submit(target, *args, threads=threads, **options)] = k
+            for future in as_completed(futures):
+                result = future.result()
+                if telemetry.enabled:
+                    result, samples, caches = result
+                    telemetry.merge(samples, caches)
+                stats.append(result)
+                manifest.complete(futures[future])
+    else:
+        for k in pending:
+            args, options = arguments(k)
+            print(f'Rendering segment {k + 1}/{len(segments)}...')
+            stats.append(render_segment(*args, render_threads=max(1, (os.cpu_count() or 1) // 2),
+                                        telemetry=telemetry, **options))
+            manifest.complete(k)
+
+    with telemetry.stage('concat'):
+        for j, spec in enumerate(specs):
+            concat_segments([part[j]['output'] for part in parts], spec['output'],
+                            audio=audio, audio_start=audio_start, duration=len(signals) / signals.fps)
+
+    for part in parts:
+        for spec in part:
+            os.remove(spec['output'])
+    manifest.remove()
+
+    stats = [result for result in stats if result is not None]
+    if stats:
+        print(hit_rate_report('Frame cache', *map(sum, zip(*stats))))
@@ -0,0 +1,297 @@
+import argparse
+import inspect
+import json
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from . import anim
+from .pipeline import parse_effects
+
+
+# Defaults of the create_animation arguments a job may set
+JOB_DEFAULTS = {
+    name: parameter.default
+    for name, parameter in inspect.signature(anim.create_animation).parameters.items()
+}
+
+# Manifest fields that are spelled differently from create_animation's arguments
+JOB_ALIASES = {'input': 'img', 'start': 'start_time', 'end': 'end_time'}
+
+
+def parse_time(value):
+    """Parse a command line time, either as seconds or as 'm:ss'."""
+    return value if ':' in value else float(value)
+
+
+def job_arguments(job):
+    """Return the create_animation keyword arguments for a manifest entry."""
+    kwargs = {}
+    for field, value in job.items():
+        name = JOB_ALIASES.get(field, field)
+        if name not in JOB_DEFAULTS:
+            raise ValueError(f'Unknown job field: {field}')
+        kwargs[name] = value
+    if not kwargs.get('img') and not kwargs.get('video'):
+        raise ValueError('Job has no input')
+    if not kwargs.get('output'):
+        raise ValueError('Job has no output')
+    if kwargs.get('effects') is not None:
+        kwargs['effects'] = parse_effects(kwargs['effects'])
+    return kwargs
+
+
+def load_jobs(path):
+    """Read a JSON Lines manifest holding one job object per line.
+
+    Blank lines are skipped. Returns a list of create_animation keyword
+    arguments, one per job.
+    """
+    jobs = []
+    with open(path) as manifest:
+        for line_number, line in enumerate(manifest, 1):
+            if not line.strip():
+                continue
+            try:
+                jobs.append(job_arguments(json.loads(line)))
+            except ValueError as e:
+                raise ValueError(f'{path}:{line_number}: {e}') from None
+    return jobs
+
+
+def analysis_key(kwargs):
+    """Return what the analysis of a job depends on, so jobs can share it.
+
+    The inputs are compared before they're resolved, which is enough to
+    tell apart every pair of jobs that would analyse differently.
+    """
+    params = {**JOB_DEFAULTS, **kwargs}
+    source = params['audio'] or params['video'] or params['img']
+    return (os.path.abspath(source), params['start_time'], params['end_time'], params['fps'],
+            params['frame_smoothing'], params['analysis_horizon'], str(params['analysis_cache']))
+
+
+def analyze_job(kwargs):
+    """Analyse the audio of a job into the analysis cache. Runs in a worker process."""
+    params = {**JOB_DEFAULTS, **kwargs}
+    img, video, start_time, end_time, fps = anim.resolve_inputs(
+        params['img'], params['video'], params['start_time'], params['end_time'], params['fps'])
+    source = video if video and not params['audio'] else params['audio']
+    anim.analyze_audio(source, start_time=start_time, end_time=end_time, fps=fps,
+                       frame_smoothing=params['frame_smoothing'], visualizer=params['visualizer'],
+                       analysis_cache=params['analysis_cache'], analysis_horizon=params['analysis_horizon'])
+
+
+def run_job(kwargs):
+    """Render one job, returning (error, seconds). Runs in a worker process."""
+    start = time.perf_counter()
+    try:
+        anim.create_animation(**kwargs)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    return error, time.perf_counter() - start
+
+
+def run_batch(jobs, processes=None, report=None):
+    """Render `jobs` on a pool of `processes` worker processes.
+
+    Jobs whose audio is analysed the same way share one analysis: it is
+    computed once up front and stored in the analysis cache, where their
+    renders find it. Prints the status and time of every job as it
+    finishes and, if `report` is given, writes them to that JSON file.
+
+    Returns the number of failed jobs.
+    """
+    start = time.perf_counter()
+    groups = {}
+    for kwargs in jobs:
+        if kwargs.get('analysis_cache'):
+            groups.setdefault(analysis_key(kwargs), []).append(kwargs)
+    shared = [group for group in groups.values() if len(group) > 1]
+
+    results = [None] * len(jobs)
+    with ProcessPoolExecutor(processes) as executor:
+        if shared:
+            print(f'Analyzing {len(shared)} shared audio tracks...')
+            # One analysis per group, with the visualizer if any job of the group needs it
+            futures = {
+                executor.submit(analyze_job, dict(group[0], visualizer=any(kwargs.get('visualizer') for kwargs in group))): group
+                for group in shared
+            }
+            for future in as_completed(futures):
+                if future.exception() is not None:
+                    # The jobs will run the analysis themselves and report the error
+                    print(f'Shared analysis failed: {future.exception()}', file=sys.stderr)
+
+        futures = {executor.submit(run_job, kwargs): index for index, kwargs in enumerate(jobs)}
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                error, seconds = future.result()
+            except Exception:  # e.g. the worker process died
+                error, seconds = traceback.format_exc(), None
+            results[index] = {
+                'job': index,
+                'output': jobs[index]['output'],
+                'status': 'failed' if error else 'ok',
+                'seconds': seconds,
+                'error': error,
+            }
+            timing = '' if seconds is None else f' in {seconds:.1f}s'
+            print(f"[{index}] {results[index]['status']}: {jobs[index]['output']}{timing}")
+            if error:
+                print(error, file=sys.stderr)
+
+    failed = sum(result['status'] != 'ok' for result in results)
+    print(f'{len(jobs) - failed}/{len(jobs)} jobs succeeded in {time.perf_counter() - start:.1f}s')
+    if report:
+        with open(report, 'w') as report_file:
+            json.dump(results, report_file, indent=2)
+    return failed
+
+
+def add_render_options(parser):
+    parser.add_argument('--fps', type=float, help='frame rate for image inputs (default: 30)')
+    parser.add_argument('--effects', help="effect chain as name:band pairs with optional :parameter=value items, "
+                             "e.g. 'zoom:low:max_zoom=0.2,noise_bands:high'")
+    parser.add_argument('--visualizer', action='store_true', default=None, help='draw a spectrum visualizer')
+    parser.add_argument('--workers', type=int, help='number of processes rendering segments of the video')
+    parser.add_argument('--frame-cache', type=int, help='frame cache size in MiB, for image inputs')
+    parser.add_argument('--codec', help='ffmpeg video encoder (default: libx264)')
+    parser.add_argument('--preset', help='encoder preset (default: medium)')
+    parser.add_argument('--crf', type=int, help='constant rate factor')
+    parser.add_argument('--pix-fmt', help='output pixel format')
+    parser.add_argument('--draft', action='store_true', default=None, help='render a quick low-resolution preview')
+    parser.add_argument('--draft-scale', type=float, help='frame size of drafts relative to the input (default: 0.25)')
+    parser.add_argument('--draft-fps', type=float, help='frame rate of drafts (default: 15)')
+
+
+def render_options(args):
+    """Return the create_animation arguments set by the options of add_render_options."""
+    names = ['fps', 'effects', 'visualizer', 'workers', 'frame_cache', 'codec', 'preset', 'crf', 'pix_fmt',
+             'draft', 'draft_scale', 'draft_fps']
+    kwargs = {name: getattr(args, name) for name in names if getattr(args, name) is not None}
+    if 'effects' in kwargs:
+        kwargs['effects'] = parse_effects(kwargs['effects'])
+    return kwargs
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='animusic', description='Create audio-reactive music videos without the GUI.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    render = commands.add_parser('render', help='render a single video')
+    render.add_argument('input', help='image or video to animate')
+    render.add_argument('audio', nargs='?', help='audio track (default: the audio of the input video)')
+    render.add_argument('-o', '--output', default='animusic.mp4', help='output video (default: animusic.mp4)')
+    render.add_argument('--start', type=parse_time, help='start time in seconds or m:ss')
+    render.add_argument('--end', type=parse_time, help='end time in seconds or m:ss')
+    render.add_argument('--analysis-cache', nargs='?', const=True, metavar='DIR',
+                        help='reuse cached audio analyses (optionally stored in DIR)')
+    render.add_argument('--profile', metavar='PATH', help='write the time spent in every stage to a JSON report')
+    render.add_argument('--checkpoint', metavar='DIR',
+                        help='render in segments checkpointed to DIR, so rerunning a killed render resumes it')
+    render.add_argument('--segment-seconds', type=float, help='length of checkpointed segments (default: 60)')
+    add_render_options(render)
+
+    batch = commands.add_parser('batch', help='render the jobs of a JSON Lines manifest')
+    batch.add_argument('manifest', help='file with one job object per line, with the fields '
+                                        'input, audio, output, start, end, fps, effects, ...')
+    batch.add_argument('-j', '--jobs', type=int, default=None, help='number of worker processes (default: CPU count)')
+    batch.add_argument('--analysis-cache', metavar='DIR', help='analysis cache directory (default: ~/.cache/animusic/analysis)')
+    batch.add_argument('--no-analysis-cache', action='store_true', help="don't cache or share the audio analysis")
+    batch.add_argument('--report', metavar='PATH', help='write the status and timing of every job to a JSON file')
+    add_render_options(batch)
+
+    stream = commands.add_parser('stream', help='animate an image from live audio and stream it')
+    stream.add_argument('input', help='image to animate')
+    stream.add_argument('audio', help="audio file or URL, or '-' for raw float32 samples on stdin")
+    stream.add_argument('-o', '--output', required=True, help='output video file or streaming URL, e.g. rtmp://...')
+    stream.add_argument('--fps', type=float, default=30, help='frame rate (default: 30)')
+    stream.add_argument('--sample-rate', type=int, default=44100, help='sample rate of the audio (default: 44100)')
+    stream.add_argument('--channels', type=int, default=2, help='channels of the audio (default: 2)')
+    stream.add_argument('--effects', help="effect chain as name:band pairs with optional :parameter=value items, "
+                             "e.g. 'zoom:low:max_zoom=0.2,noise_bands:high'")
+    stream.add_argument('--codec', default='libx264', help='ffmpeg video encoder (default: libx264)')
+    stream.add_argument('--preset', default='ultrafast', help='encoder preset (default: ultrafast)')
+    stream.add_argument('--bitrate', help="video bitrate, e.g. '4M'")
+    stream.add_argument('--format', help="output container (default: 'flv' for rtmp:// URLs)")
+    stream.add_argument('--no-realtime', action='store_true', help="don't pace the output at playback rate")
+
+    bench = commands.add_parser('bench', help='benchmark the effects, the analysis and rendering on generated inputs')
+    bench.add_argument('-o', '--output', metavar='PATH', help='write the results to a JSON file')
+    bench.add_argument('--baseline', metavar='PATH', help='JSON results of an earlier run to compare against')
+    bench.add_argument('--threshold', type=float, default=0.1,
+                       help='slowdown (as a fraction) that counts as a regression (default: 0.1)')
+    bench.add_argument('--select', metavar='TEXT', help='only run the benchmarks whose name contains TEXT')
+    bench.add_argument('--repeat', type=int, default=5, help='timed runs of every benchmark (default: 5)')
+    bench.add_argument('--quick', action='store_true', help='only 720p and a short track')
+    return parser
+
+
+def bench(args):
+    """Run the benchmarks, exiting non-zero if any regressed against the baseline."""
+    from . import benchmark
+
+    results = benchmark.run(quick=args.quick, select=args.select, repeat=args.repeat)
+    if args.output:
+        benchmark.save(results, args.output)
+    if not args.baseline:
+        return 0
+
+    regressions = benchmark.compare(benchmark.load(args.baseline), results, threshold=args.threshold)
+    for name, before, after in regressions:
+        print(f'Regression: {name} {before * 1000:.2f} ms -> {after * 1000:.2f} ms ({after / before - 1:+.0%})')
+    print(f'{len(regressions)} regressions against {args.baseline}')
+    return 1 if regressions else 0
+
+
+def main(argv=None):
+    """Run the headless command line interface, returning the exit status."""
+    args = build_parser().parse_args(argv)
+
+    if args.command == 'bench':
+        return bench(args)
+
+    if args.command == 'stream':
+        from .streaming import stream_animation
+
+        stream_animation(args.input, args.audio, args.output, fps=args.fps, sample_rate=args.sample_rate,
+                         channels=args.channels, effects=parse_effects(args.effects) if args.effects else None,
+                         realtime=False if args.no_realtime else None, codec=args.codec, preset=args.preset,
+                         bitrate=args.bitrate, format=args.format)
+        return 0
+
+    if args.command == 'render':
+        kwargs = dict(render_options(args), img=args.input, audio=args.audio, output=args.output)
+        if args.start is not None:
+            kwargs['start_time'] = args.start
+        if args.end is not None:
+            kwargs['end_time'] = args.end
+        if args.analysis_cache:
+            kwargs['analysis_cache'] = args.analysis_cache
+        if args.profile:
+            kwargs['profile'] = args.profile
+        if args.checkpoint:
+            kwargs['checkpoint'] = args.checkpoint
+        if args.segment_seconds is not None:
+            kwargs['segment_seconds'] = args.segment_seconds
+        error, seconds = run_job(kwargs)
+        if error:
+            print(error, file=sys.stderr)
+            return 1
+        print(f'Rendered {args.output} in {seconds:.1f}s')
+        return 0
+
+    try:
+        jobs = load_jobs(args.manifest)
+    except (OSError, ValueError) as e:
+        print(e, file=sys.stderr)
+        return 2
+    # Command line options are defaults that every job can override
+    defaults = render_options(args)
+    defaults['analysis_cache'] = None if args.no_analysis_cache else (args.analysis_cache or True)
+    jobs = [{**defaults, **kwargs} for kwargs in jobs]
+    return 1 if run_batch(jobs, processes=args.jobs, report=args.report) else 0
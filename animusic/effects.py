@@ -1,28 +1,42 @@
 import numpy as np
-import matplotlib.pyplot as plt
-from PIL import Image, ImageChops
+from functools import lru_cache
 
 
-def sin_wave_distortion(img, signal, mag=10, freq=20):
+def _roll_into(dst, src, shift):
+    """Write np.roll(src, shift) for 1-D arrays into dst without temporaries."""
+    shift %= len(src)
+    dst[shift:] = src[:len(src) - shift]
+    dst[:shift] = src[len(src) - shift:]
+
+
+def sin_wave_distortion(img, signal, mag=10, freq=20, out=None):
     """Return an image with rows shifted according to a sine curve.
 
     im: Pillow Image
     mag: The magnitude of the sine wave
     freq: The frequency of the sine wave
     phase: The degree by which the cycle is offset (rads)
+    out: Optional array to write the result into (must not be `img`)
     """
-    img = img.copy()
+    if out is None:
+        out = np.empty_like(img)
     phase = -2 * np.pi * signal
     mag = mag * signal
     height = img.shape[0]
     offsets = (mag * np.sin(2 * np.pi * freq * (np.arange(height) / height) + phase)).astype(int)
-    for offset in np.unique(offsets):
-        idx = (offsets==offset)
-        img[idx] = np.roll(img[idx], offset, axis=1)
-    return img
-
-
-def chromatic_aberration(img, signal, mag=10):
+    # The offsets follow a smooth curve, so rows sharing an offset form a few
+    # contiguous runs that can each be rolled with two slice copies
+    width = img.shape[1]
+    starts = np.r_[0, np.flatnonzero(np.diff(offsets)) + 1]
+    ends = np.r_[starts[1:], height]
+    for start, end, offset in zip(starts.tolist(), ends.tolist(), offsets[starts].tolist()):
+        shift = offset % width
+        out[start:end, shift:] = img[start:end, :width - shift]
+        out[start:end, :shift] = img[start:end, width - shift:]
+    return out
+
+
+def chromatic_aberration(img, signal, mag=10, out=None):
     """
     Return an image where the color channels are horizontally offset.
 
@@ -31,141 +45,120 @@ def chromatic_aberration(img, signal, mag=10):
 
     im: RGB array
     offset: distance in pixels the color channels should be offset by
+    out: Optional contiguous array to write the result into (must not be `img`)
     """
-    img = img.copy()
+    if out is None:
+        out = np.empty_like(img)
     offset = int(mag * signal)
-    img[:,:,0] = np.roll(img[:,:,0], -offset)
-    img[:,:,2] = np.roll(img[:,:,2], offset)
-    return img
-
-
-def hsv_to_rgb(h, s, v):
-    if s == 0.0: v*=255; return (v, v, v)
-    i = int(h*6.) # XXX assume int() truncates!
-    f = (h*6.)-i; p,q,t = int(255*(v*(1.-s))), int(255*(v*(1.-s*f))), int(255*(v*(1.-s*(1.-f)))); v*=255; i%=6
-    if i == 0: return (v, t, p)
-    if i == 1: return (q, v, p)
-    if i == 2: return (p, v, t)
-    if i == 3: return (p, q, v)
-    if i == 4: return (t, p, v)
-    if i == 5: return (v, p, q)
-
-
-def make_noise_data(length, min_luminosity=0, max_luminosity=0.75):
-    """Return a list of RGB tuples of random greyscale values.
-
-    length: The length of the list
-    min_luminosity: The lowest luminosity value (between 0 and 1)
-    max_luminosity: The brightest luminosity value (between 0 and 1)
+    # Each channel is rolled as one flat array, like np.roll without an axis
+    src = np.ascontiguousarray(img).reshape(-1, img.shape[-1])
+    dst = out.reshape(-1, out.shape[-1])
+    _roll_into(dst[:,0], src[:,0], -offset)
+    dst[:,1] = src[:,1]
+    _roll_into(dst[:,2], src[:,2], offset)
+    dst[:,3:] = src[:,3:]
+    return out
+
+
+def noise_bands(img, signal, mag=5, min_luminosity=0, max_luminosity=0.75, seed=0, out=None):
+    """Return an image with randomly placed full-width bands of grey noise.
+
+    Up to `mag * signal` bands, each up to `mag * signal` rows thick, are
+    lightened with noise and blended over the image at half opacity. The
+    noise is drawn from a generator seeded with `seed` and the signal, so a
+    frame only depends on its signal, like every other effect, and can be
+    reproduced by any worker or served from a frame cache.
+
+    img: RGB(A) array
+    mag: Maximum number and thickness of the bands
+    min_luminosity: The lowest luminosity of the noise (between 0 and 1)
+    max_luminosity: The brightest luminosity of the noise (between 0 and 1)
+    seed: Seed of the noise
+    out: Optional array to write the result into (must not be `img`)
     """
-    noise_data = []
-    for _ in range(length):
-        l = round(np.random.uniform(min_luminosity, max_luminosity) * 255)
-        rgb = (l,l,l)
-        noise_data.append(rgb)
-    return noise_data
+    if out is None:
+        out = np.empty_like(img)
+    out[...] = img
+    count = int(mag * signal)
+    if count <= 0:
+        return out
+    height, width = img.shape[:2]
+    rng = np.random.default_rng([seed, int(round(signal * 2**24))])
+    tops = rng.integers(0, height, size=count)
+    bottoms = np.minimum(tops + rng.integers(1, max(2, count), size=count), height)
 
+    # Rows covered by any band: +1 where a band starts, -1 where it ends
+    edges = np.zeros(height + 1, dtype=np.intp)
+    np.add.at(edges, tops, 1)
+    np.add.at(edges, bottoms, -1)
+    rows = np.flatnonzero(np.cumsum(edges[:height]))
 
-def noise_bands(im, signal, mag=5):
-    """Return an image with randomly placed full-width bands of noise.
+    low, high = round(min_luminosity * 255), round(max_luminosity * 255)
+    noise = rng.integers(low, high + 1, size=(len(rows), width, 1), dtype=np.uint16)
+    band = out[rows, :, :3].astype(np.uint16)
+    # Half-opacity blend of the lighter of the image and the noise
+    out[rows, :, :3] = (band + np.maximum(band, noise) + 1) >> 1
+    return out
 
-    im: Pillow Image
-    count: The number of bands of noise
-    thickness: Maximum thickness of the bands
-    """
-    count = int(mag * signal)
-    thickness = int(mag * signal)
-    modified = im.convert('RGBA')
-    boxes = [
-        (0, ypos, im.size[0], ypos + np.random.randint(1, thickness))
-        for ypos in np.random.choices(range(im.size[1]), k=count)
-    ]
-    for box in boxes:
-        noise_cell = Image.new(modified.mode, (box[2]-box[0], box[3]-box[1]))
-        noise_cell.putdata(
-            make_noise_data(noise_cell.size[0] * noise_cell.size[1])
-        )
-        combined_cell = ImageChops.lighter(modified.crop(box), noise_cell)
-        combined_cell.putalpha(128)
-        modified.alpha_composite(combined_cell, (box[0], box[1]))
 
-    return modified.convert(im.mode)
+def _luminance(img):
+    """Return the Rec. 709 luminance of an image array, truncated to uint8 like int() does."""
+    return (0.2126 * img[..., 0] + 0.7152 * img[..., 1] + 0.0722 * img[..., 2]).astype(np.uint8)
 
 
-def _split_data(data, width):
-    height = int(len(data) / width)
-    return [
-        data[(row * width):(row * width + width)]
-        for row in range(height)
-    ]
+def _pillow_luminance(img):
+    """Return the luminance of Pillow's 'L' conversion, ITU-R 601-2 in rounded 16-bit fixed point.
 
+    The fixed-point sums stay below 2**24, so float32 holds them exactly.
+    """
+    weighted = img[..., :3] @ np.array([19595, 38470, 7471], dtype=np.float32)
+    return np.floor((weighted + 0x8000) * (1 / 0x10000))
 
-def _get_lum(rgb):
-    return int(0.2126 * rgb[0] + 0.7152 * rgb[1] + 0.0722 * rgb[2])
 
+def pixel_sort(img, signal, multiplier=2, reverse=True, out=None):
+    """Return an image where dark horizontal runs of pixels are sorted by luminance.
 
-def pixel_sort(im, signal, multiplier=2, reverse=True):
-    """Return a horizontally pixel-sorted Image based on the mask function.
+    Pixels darker than `multiplier * signal` times the median luminance are
+    sorted, in every contiguous run of them along each row. The runs are
+    found with run-length operations on the mask and all of them are sorted
+    at once with a single stable argsort on (run, luminance) keys.
 
-    The default sorting direction is dark to light from left to right.
+    The default sorting direction is light to dark from left to right.
 
     Pixel-sorting algorithm from: http://satyarth.me/articles/pixel-sorting/
 
-    im: Pillow Image
-    mask_function: function that takes a pixel's luminance and returns
-        255 or 0 depending on whether it should be sorted or not respectively.
-    reverse: sort pixels in reverse order if True
+    img: RGB(A) array
+    multiplier: Pixel sorting strength relative to the median luminance
+    reverse: Sort pixels from light to dark if True, dark to light otherwise
+    out: Optional array to write the result into (must not be `img`)
     """
-    median_lum = np.median(np.multiply(im, np.array([0.2126, 0.7152, 0.0722]), casting='unsafe').sum(axis=-1).astype(int))
-    lum_limit = multiplier * median_lum # <- pixel sorting strength
+    if out is None:
+        out = np.empty_like(img)
+    height, width = img.shape[:2]
+    pixels = np.ascontiguousarray(img).reshape(height * width, -1)
+    out_pixels = out.reshape(height * width, -1)
+    out_pixels[:] = pixels
+
+    # The median and the sort keys use Rec. 709 luminance, the mask Pillow's 'L' conversion
+    lum = _luminance(img)
+    lum_limit = multiplier * np.median(lum.astype(int))
     lum_limit = abs(lum_limit) if lum_limit <= 255 else 255
-    mask_function = (lambda val, factor=signal, limit=lum_limit:
-                    255 if val < limit * factor else 0)
-    
-    # Create a black-and-white mask to determine which pixels will be sorted
-    interval_mask = im.convert('L').point(mask_function)
-    interval_mask_data = list(interval_mask.getdata())
-    interval_mask_row_data = _split_data(interval_mask_data, im.size[0])
-
-    # Go row by row, recording the starting and ending points of each
-    # contiguous block of white pixels in the mask
-    interval_boxes = []
-    for row_index, row_data in enumerate(interval_mask_row_data):
-        for pixel_index, pixel in enumerate(row_data):
-            # This is the first pixel on the row and it is white -> start box
-            if pixel_index == 0 and pixel == 255:
-                start = (pixel_index, row_index)
-                continue
-            # The pixel is white and the previous pixel was black -> start box
-            if pixel == 255 and row_data[pixel_index - 1] == 0:
-                start = (pixel_index, row_index)
-                continue
-            # This is the last pixel in the row and it is white -> end box
-            if pixel_index == len(row_data) - 1 and pixel == 255:
-                end = (pixel_index, row_index + 1)
-                interval_boxes.append((start[0], start[1], end[0], end[1]))
-                continue
-            # The pixel is (black) and (not the first in the row) and (the
-            # previous pixel was white) -> end box
-            if (pixel == 0 and pixel_index > 0 and
-                    row_data[pixel_index - 1] == 255):
-                end = (pixel_index, row_index + 1)
-                interval_boxes.append((start[0], start[1], end[0], end[1]))
-                continue
-
-    modified = im
-    for box in interval_boxes:
-        # Take the pixels from each box
-        cropped_interval = modified.crop(box)
-        interval_data = list(cropped_interval.getdata())
-        # sort them by luminance
-        cropped_interval.putdata(
-            sorted(interval_data, key=_get_lum, reverse=reverse)
-        )
-        # and paste them back onto the image!
-        modified.paste(cropped_interval, box=(box[0], box[1]))
-
-    return modified
+    mask = _pillow_luminance(img) < lum_limit * signal
+    if not mask.any():
+        return out
+
+    # A run starts at every masked pixel whose left neighbour in the row isn't masked
+    starts = mask.copy()
+    starts[:, 1:] &= ~mask[:, :-1]
+    index = np.flatnonzero(mask)
+    runs = np.cumsum(starts.ravel()[index])
+
+    keys = lum.ravel()[index].astype(np.int64)
+    if reverse:
+        keys = 255 - keys
+    order = np.argsort(runs * 256 + keys, kind='stable')
+    out_pixels[index] = pixels[index[order]]
+    return out
 
 
 # def zoom(img, signal, max_zoom=0.1):
@@ -211,17 +204,8 @@ def pixel_sort(im, signal, multiplier=2, reverse=True):
 #         out = img
 #     return out
 
-def zoom(img, signal, max_zoom=0.10):
-    """
-    Center zoom in/out of the given image and returning an enlarged/shrinked view of 
-    the image without changing dimensions
-    Args:
-        img : Image array
-        zoom_factor : amount of zoom as a ratio (0 to Inf)
-    """
-    zoom_factor = 1 + max_zoom * signal
-    
-    height, width = img.shape[:2] # It's also the final desired shape
+def _zoom_geometry(height, width, zoom_factor):
+    """Return the source crop box and the size and offset of the resized crop."""
     new_height, new_width = int(height * zoom_factor), int(width * zoom_factor)
 
     ### Crop only the part that will remain in the result (more efficient)
@@ -230,21 +214,108 @@ def zoom(img, signal, max_zoom=0.10):
     y2, x2 = y1 + height, x1 + width
     bbox = np.array([y1,x1,y2,x2])
     # Map back to original image coordinates
-    bbox = (bbox / zoom_factor).astype(np.int)
+    bbox = (bbox / zoom_factor).astype(int)
     y1, x1, y2, x2 = bbox
-    cropped_img = img[y1:y2, x1:x2]
+    y2, x2 = min(y2, height), min(x2, width)
 
     # Handle padding when downscaling
     resize_height, resize_width = min(new_height, height), min(new_width, width)
-    pad_height1, pad_width1 = (height - resize_height) // 2, (width - resize_width) //2
-    pad_height2, pad_width2 = (height - resize_height) - pad_height1, (width - resize_width) - pad_width1
-    pad_spec = [(pad_height1, pad_height2), (pad_width1, pad_width2)] + [(0,0)] * (img.ndim - 2)
-
-    # result = cv2.resize(cropped_img, (resize_width, resize_height))
-    result = np.array(Image.fromarray(cropped_img).resize((resize_width, resize_height), Image.NEAREST))
-    result = np.pad(result, pad_spec, mode='constant')
-    assert result.shape[0] == height and result.shape[1] == width
-    return result
+    top, left = (height - resize_height) // 2, (width - resize_width) //2
+    return (y1, x1, y2, x2), (resize_height, resize_width), (top, left)
+
+
+def _sample_positions(length, size):
+    """Coordinates sampled by `size` output pixels spanning `length` source pixels.
+
+    The coordinates are accumulated step by step like Pillow does, so that
+    truncating them picks the same pixels as Image.resize with NEAREST.
+    """
+    scale = length / size
+    steps = np.full(size, scale)
+    steps[0] = 0.5 * scale
+    return np.cumsum(steps)
+
+
+@lru_cache(maxsize=256)
+def _zoom_index(height, width, zoom_factor, interpolation):
+    """Cached gather indices for zooming a (height, width) image by zoom_factor.
+
+    Only row and column vectors are cached, so an entry takes height + width
+    indices and the cache holds every zoom level of a render. For 'nearest'
+    they are the first and last source rows used, the source row of every
+    output row relative to the first one and the source column of every
+    output column. For 'bilinear' they are the neighbouring rows and columns
+    of every output pixel along with their interpolation weights.
+    """
+    (y1, x1, y2, x2), (resize_height, resize_width), _ = _zoom_geometry(height, width, zoom_factor)
+    ys = _sample_positions(y2 - y1, resize_height)
+    xs = _sample_positions(x2 - x1, resize_width)
+
+    if interpolation == 'nearest':
+        rows = np.minimum(ys.astype(np.intp), y2 - y1 - 1)
+        cols = x1 + np.minimum(xs.astype(np.intp), x2 - x1 - 1)
+        first = y1 + int(rows[0])
+        last = y1 + int(rows[-1])
+        rows -= rows[0]
+        rows.flags.writeable = False
+        cols.flags.writeable = False
+        return first, last, rows, cols
+
+    if interpolation == 'bilinear':
+        ys = np.clip(y1 + ys - 0.5, 0, height - 1)
+        xs = np.clip(x1 + xs - 0.5, 0, width - 1)
+        rows0, cols0 = np.floor(ys).astype(np.intp), np.floor(xs).astype(np.intp)
+        rows1, cols1 = np.minimum(rows0 + 1, height - 1), np.minimum(cols0 + 1, width - 1)
+        wy = (ys - rows0).astype(np.float32)[:, None, None]
+        wx = (xs - cols0).astype(np.float32)[None, :, None]
+        return (rows0, rows1, wy), (cols0, cols1, wx)
+
+    raise ValueError(f'Unknown interpolation: {interpolation}')
+
+
+def zoom(img, signal, max_zoom=0.10, interpolation='nearest', step=1e-3, out=None):
+    """
+    Center zoom in/out of the given image and returning an enlarged/shrinked view of 
+    the image without changing dimensions
+
+    The zoom factor is quantized to `step` so the resampling indices can be
+    cached and reused across frames; each frame is then a gather of columns
+    followed by a gather of rows.
+    Args:
+        img : Image array
+        zoom_factor : amount of zoom as a ratio (0 to Inf)
+        interpolation : 'nearest' or 'bilinear'
+        step : quantization step of the zoom factor (None to disable)
+        out : Optional array to write the result into (must not be `img`)
+    """
+    zoom_factor = 1 + max_zoom * signal
+    if step:
+        zoom_factor = round(zoom_factor / step) * step
+    
+    height, width = img.shape[:2] # It's also the final desired shape
+    if out is None:
+        out = np.empty_like(img)
+    _, (resize_height, resize_width), (top, left) = _zoom_geometry(height, width, zoom_factor)
+    index = _zoom_index(height, width, zoom_factor, interpolation)
+
+    if resize_height < height or resize_width < width:
+        out[:] = 0
+    target = out[top:top+resize_height, left:left+resize_width]
+
+    if interpolation == 'nearest':
+        # Gather the columns of the source rows in use, then the rows straight into the output
+        first, last, rows, cols = index
+        columns = np.take(img[first:last + 1], cols, axis=1, mode='clip')
+        np.take(columns, rows, axis=0, out=target, mode='clip')
+        return out
+
+    # Separable: blend neighbouring rows first, then neighbouring columns
+    (rows0, rows1, wy), (cols0, cols1, wx) = index
+    source = img.reshape(height, width, -1)
+    blended = source[rows0] * (1 - wy) + source[rows1] * wy
+    result = np.rint(blended[:, cols0] * (1 - wx) + blended[:, cols1] * wx)
+    target[...] = result.reshape(resize_height, resize_width, *img.shape[2:])
+    return out
 
 # def barrel_distortion(im, signal):
 #     im_bytes = BytesIO()
@@ -0,0 +1,256 @@
+import functools
+import inspect
+import json
+import threading
+import numpy as np
+from . import effects
+from .telemetry import NULL_TELEMETRY
+
+
+# The effect chain used by create_animation, as (effect, band) pairs
+DEFAULT_EFFECTS = [
+    (effects.chromatic_aberration, 'high'),
+    (effects.sin_wave_distortion, 'high'),
+    (effects.zoom, 'low'),
+]
+
+# Effect parameters measured in pixels, which must follow the frame size
+PIXEL_PARAMETERS = {
+    effects.chromatic_aberration: ['mag'],
+    effects.sin_wave_distortion: ['mag'],
+}
+
+# Bands of the signals computed by the analysis
+BANDS = ('low', 'high')
+
+# Effects that can be used in a chain, by name. Besides the default ones,
+# pixel_sort and noise_bands work well driven by the high band ('pixel_sort:high').
+# Every effect is called as effect(img, signal=signal, out=out, **parameters)
+# with an ndarray frame, writes the result into `out` and returns it.
+EFFECTS = {effect.__name__: effect for effect in [
+    effects.chromatic_aberration,
+    effects.sin_wave_distortion,
+    effects.zoom,
+    effects.pixel_sort,
+    effects.noise_bands,
+]}
+
+
+def effect_function(effect):
+    """Return the callable behind an effect, unwrapping functools.partial."""
+    while isinstance(effect, functools.partial):
+        effect = effect.func
+    return effect
+
+
+def effect_parameters(effect):
+    """Return the keyword arguments bound to an effect with functools.partial, outermost last."""
+    if not isinstance(effect, functools.partial):
+        return {}
+    return {**effect_parameters(effect.func), **effect.keywords}
+
+
+def effect_name(effect):
+    """Return the name of an effect, also for partials and callable objects without a __name__."""
+    function = effect_function(effect)
+    return getattr(function, '__name__', None) or type(function).__name__
+
+
+def parse_value(text):
+    """Parse a parameter value from the command line, as JSON if possible and as a string otherwise."""
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+
+def configure_effect(name, band, **parameters):
+    """Return the (effect, band) pair for an effect of EFFECTS with its parameters set.
+
+    The parameters are bound with functools.partial, where scale_effects
+    and checkpoint fingerprints read them back from.
+    """
+    if name not in EFFECTS:
+        raise ValueError(f'Unknown effect: {name} (expected one of {", ".join(EFFECTS)})')
+    if band not in BANDS:
+        raise ValueError(f'Unknown band: {band} (expected one of {", ".join(BANDS)})')
+    effect = EFFECTS[name]
+    if parameters:
+        accepted = set(inspect.signature(effect).parameters) - {'img', 'signal', 'out'}
+        unknown = set(parameters) - accepted
+        if unknown:
+            raise ValueError(f'Unknown parameters of {name}: {", ".join(sorted(unknown))} '
+                             f'(expected some of {", ".join(sorted(accepted))})')
+        effect = functools.partial(effect, **parameters)
+    return effect, band
+
+
+def parse_effects(spec):
+    """Return the (effect, band) pairs described by `spec`.
+
+    spec: One of
+        - 'name:band' strings separated by commas, each optionally followed
+          by ':parameter=value' items, e.g. 'zoom:low:max_zoom=0.2'
+        - a list of such strings, of [name, band] pairs or of
+          {'effect': name, 'band': band, parameter: value, ...} objects
+        - a mapping of effect names to bands, or to {'band': band,
+          parameter: value, ...} objects, e.g. {'zoom': 'low'}
+    """
+    if isinstance(spec, str):
+        spec = [item for item in spec.split(',') if item.strip()]
+    elif isinstance(spec, dict):
+        spec = [
+            dict(options, effect=name) if isinstance(options, dict) else {'effect': name, 'band': options}
+            for name, options in spec.items()
+        ]
+    chain = []
+    for item in spec:
+        if isinstance(item, dict):
+            parameters = dict(item)
+            try:
+                name, band = parameters.pop('effect'), parameters.pop('band')
+            except KeyError as e:
+                raise ValueError(f'Effect without {e.args[0]}: {item}') from None
+        elif isinstance(item, str):
+            name, band, *options = item.split(':')
+            parameters = {}
+            for option in options:
+                key, _, value = option.partition('=')
+                parameters[key.strip()] = parse_value(value.strip())
+        else:
+            name, band = item
+            parameters = {}
+        chain.append(configure_effect(name.strip(), band.strip(), **parameters))
+    return chain
+
+
+def resolve_effects(effects):
+    """Return the (effect, band) pairs of a chain given as pairs or in any form parse_effects accepts.
+
+    effects: None for DEFAULT_EFFECTS, (effect, band) pairs with callable
+        effects, or a declarative spec, see parse_effects
+    """
+    if effects is None:
+        return list(DEFAULT_EFFECTS)
+    if isinstance(effects, (str, dict)) or not all(
+            isinstance(item, tuple) and callable(item[0]) for item in effects):
+        return parse_effects(effects)
+    return list(effects)
+
+
+def scale_effects(chain, scale):
+    """Return the (effect, band) pairs of `chain` adapted to frames resized by `scale`.
+
+    Parameters measured in pixels (see PIXEL_PARAMETERS) are scaled so the
+    effects look the same on the resized frames, e.g. for a draft render.
+    Relative parameters such as the zoom ratio need no change. Parameters
+    configured with functools.partial are scaled from their configured
+    values, the others from the effect's defaults.
+    """
+    scaled = []
+    for effect, band in chain:
+        function = effect_function(effect)
+        names = PIXEL_PARAMETERS.get(function, [])
+        if names:
+            configured = effect_parameters(effect)
+            defaults = inspect.signature(function).parameters
+            pixels = {name: configured.get(name, defaults[name].default) * scale for name in names}
+            effect = functools.partial(function, **{**configured, **pixels})
+        scaled.append((effect, band))
+    return scaled
+
+
+class EffectChain:
+    """Apply a sequence of audio-reactive effects to a frame in a single call.
+
+    Every effect writes into one of two scratch buffers that are allocated
+    once per worker thread and reused for every frame, so rendering a frame
+    does not allocate new full-size arrays. Effects whose signal is zero for
+    the current frame are skipped.
+
+    The returned frame is one of the scratch buffers (or the source frame if
+    every effect was skipped) and is overwritten by the next call on the same
+    thread, unless an `out` array is passed for the last effect to write to.
+
+    With a FrameCache, frames are rendered from quantized signals and looked
+    up by those signals first. This is only valid when the source frame is
+    the same for every call, i.e. for still images.
+
+    effects: List of (effect, band) pairs, applied in order. Each effect is
+        called as effect(img, signal=signal, out=out)
+    signals: SignalTable holding the per-frame signal of every band
+    cache: Optional FrameCache for still-image sources
+    overlay: Optional callable overlay(frame, i) drawing onto the finished
+        frame in place, e.g. a SpectrumOverlay. It runs after the cache.
+    telemetry: Optional Telemetry timing every effect and the overlay
+    """
+
+    def __init__(self, effects, signals, cache=None, overlay=None, telemetry=None):
+        self.effects = list(effects)
+        self.signals = signals
+        self.cache = cache
+        self.overlay = overlay
+        self.telemetry = telemetry or NULL_TELEMETRY
+        self._stages = ['effect.' + effect_name(effect) for effect, _ in self.effects]
+        self.bands = list(dict.fromkeys(band for _, band in self.effects))
+        self._local = threading.local()
+
+    def _buffers(self, frame):
+        buffers = getattr(self._local, 'buffers', None)
+        if buffers is None or buffers[0].shape != frame.shape or buffers[0].dtype != frame.dtype:
+            buffers = self._local.buffers = (np.empty_like(frame), np.empty_like(frame))
+        return buffers
+
+    def apply(self, frame, i, out=None):
+        """Return `frame` with the chain applied for frame number `i`.
+
+        out: Optional contiguous array to write the finished frame to instead
+            of a scratch buffer, so it outlives the next call
+        """
+        values = [self.signals.at_frame(band, i) for band in self.bands]
+        if self.cache is None:
+            result = self.render(frame, values, out)
+        else:
+            key = self.cache.key(values)
+            result = self.cache.get(key)
+            if result is None:
+                result = self.render(frame, self.cache.values(key), out)
+                self.cache.put(key, result)
+            elif out is not None:
+                out[...] = result
+                result = out
+
+        if self.overlay is not None:
+            # Never draw onto the source frame or a cached one
+            buffers = self._buffers(result)
+            if result is not out and result is not buffers[0] and result is not buffers[1]:
+                with self.telemetry.stage('composite'):
+                    buffers[0][...] = result
+                result = buffers[0]
+            with self.telemetry.stage('visualizer'):
+                result = self.overlay(result, i)
+        return result
+
+    def render(self, frame, values, out=None):
+        """Return `frame` with the chain applied for the given band signals.
+
+        values: One signal value per entry of `self.bands`
+        out: Optional array the last effect writes to, see `apply`
+        """
+        signals = dict(zip(self.bands, values))
+        active = [(effect, signals[band], stage)
+                  for (effect, band), stage in zip(self.effects, self._stages) if signals[band] != 0]
+        buffers = self._buffers(frame)
+        for k, (effect, signal, stage) in enumerate(active):
+            target = out if out is not None and k == len(active) - 1 else buffers[k % 2]
+            with self.telemetry.stage(stage):
+                frame = effect(frame, signal=signal, out=target)
+        if out is not None and frame is not out:
+            # Every effect was skipped
+            out[...] = frame
+            frame = out
+        return frame
+
+    def __call__(self, get_frame, t):
+        """Frame filter for moviepy's `clip.fl`."""
+        return self.apply(get_frame(t), self.signals.frame_index(t))
@@ -0,0 +1,146 @@
+import queue
+import subprocess
+import tempfile
+import threading
+import numpy as np
+from moviepy.config import get_setting
+from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+
+
+def scaled_size(size, scale):
+    """Return (width, height) scaled by `scale`, rounded to even numbers as most encoders need."""
+    return tuple(max(2, int(round(length * scale / 2)) * 2) for length in size)
+
+
+class FFmpegReader:
+    """Decode the frames of a video with an ffmpeg subprocess on a background thread.
+
+    Raw RGB frames are read straight into a ring of `buffers` preallocated
+    uint8 arrays, up to `buffers` frames ahead of the consumer, so decoding
+    overlaps with rendering and memory use is bounded by the ring. Frames are
+    handed out without copying: pass each one back to `release` once it's no
+    longer needed so its buffer can be reused.
+
+    The video is sampled at `fps` like moviepy does. If it ends early, its
+    last frame is repeated until `n_frames` frames have been produced.
+
+    path: Video file to decode
+    fps: Frame rate to sample the video at
+    start_frame: Number of the first frame to produce, at `fps`
+    n_frames: Number of frames to produce, by default until the video ends
+    buffers: Number of frames in the ring (at least 2)
+    scale: Factor to resize the frames by while decoding
+    """
+
+    def __init__(self, path, fps, start_frame=0, n_frames=None, buffers=8, scale=1):
+        infos = ffmpeg_parse_infos(path)
+        width, height = infos['video_size']
+        # ffmpeg applies the rotation metadata while decoding
+        if infos.get('video_rotation', 0) in (90, 270):
+            width, height = height, width
+        if scale != 1:
+            width, height = scaled_size((width, height), scale)
+        self.path = path
+        self.size = (width, height)
+        self.n_frames = n_frames
+
+        self._ring = np.empty((max(2, buffers), height, width, 3), dtype=np.uint8)
+        # Fixed views of the ring, so released frames can be mapped back to their slot
+        self._frames = list(self._ring)
+        self._slots = {id(frame): slot for slot, frame in enumerate(self._frames)}
+        self._free = queue.Queue()
+        for slot in range(len(self._frames)):
+            self._free.put(slot)
+        self._filled = queue.Queue()
+        self._closed = False
+
+        cmd = [get_setting('FFMPEG_BINARY'), '-loglevel', 'error']
+        if start_frame:
+            cmd += ['-ss', str(start_frame / fps)]
+        cmd += ['-i', path, '-an', '-r', str(fps)]
+        if scale != 1:
+            cmd += ['-vf', f'scale={width}:{height}']
+        if n_frames is not None:
+            cmd += ['-frames:v', str(n_frames)]
+        cmd += ['-f', 'rawvideo', '-pix_fmt', 'rgb24', '-vcodec', 'rawvideo', '-']
+
+        # A file rather than a pipe, so a chatty ffmpeg can never block on stderr
+        self._log = tempfile.TemporaryFile()
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=self._log)
+        self._thread = threading.Thread(target=self._decode, daemon=True)
+        self._thread.start()
+
+    def _error(self):
+        self._log.seek(0)
+        return IOError(f'ffmpeg failed to read {self.path}:\n' + self._log.read().decode('utf8', 'replace'))
+
+    def _read_into(self, frame):
+        """Fill `frame` from ffmpeg's output, returning False at the end of the video."""
+        view = memoryview(frame).cast('B')
+        n = 0
+        while n < len(view):
+            count = self.proc.stdout.readinto(view[n:])
+            if not count:
+                return False
+            n += count
+        return True
+
+    def _decode(self):
+        previous = None
+        ended = False
+        count = 0
+        try:
+            while self.n_frames is None or count < self.n_frames:
+                slot = self._free.get()
+                if slot is None:
+                    return
+                frame = self._frames[slot]
+                if not ended and not self._read_into(frame):
+                    if self._closed:
+                        return
+                    if self.proc.wait():
+                        raise self._error()
+                    ended = True
+                if ended:
+                    if previous is None or self.n_frames is None:
+                        return
+                    if slot != previous:
+                        frame[...] = self._frames[previous]
+                self._filled.put(slot)
+                previous = slot
+                count += 1
+        except Exception as e:
+            self._filled.put(e)
+        finally:
+            self._filled.put(None)
+
+    def __iter__(self):
+        """Yield the decoded frames in order, each a read-write view into the ring."""
+        while True:
+            item = self._filled.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield self._frames[item]
+
+    def release(self, frame):
+        """Hand a frame yielded by the reader back so its buffer can be reused."""
+        self._free.put(self._slots[id(frame)])
+
+    def close(self):
+        """Stop decoding and wait for ffmpeg to exit."""
+        self._closed = True
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self._free.put(None)  # wake up the decoder if it's waiting for a buffer
+        self._thread.join()
+        self.proc.wait()
+        self.proc.stdout.close()
+        self._log.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -0,0 +1,274 @@
+import itertools
+import os
+import queue
+import tempfile
+import threading
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from PIL import Image
+from moviepy.video.VideoClip import ImageClip
+from moviepy.video.io.VideoFileClip import VideoFileClip
+from moviepy.config import get_setting
+from moviepy.tools import subprocess_call
+from moviepy.video.io.ffmpeg_reader import ffmpeg_parse_infos
+from .cache import FrameCache, hit_rate_report
+from .pipeline import EffectChain, DEFAULT_EFFECTS
+from .telemetry import NULL_TELEMETRY, Telemetry
+from .visualizer import SpectrumOverlay
+from .reader import FFmpegReader, scaled_size
+from .writer import FanoutWriter, FFmpegWriter
+
+
+def load_clip(img=None, video=None, duration=None, fps=30, scale=1):
+    """Return the source clip for an image or a video file, without audio.
+
+    scale: Factor to resize images by
+    """
+    if video:
+        return VideoFileClip(video, audio=False)
+    if scale != 1:
+        image = Image.open(img).convert('RGB')
+        img = np.array(image.resize(scaled_size(image.size, scale), Image.BICUBIC))
+    return ImageClip(img, duration=duration).set_fps(fps)
+
+
+def source_size(img=None, video=None):
+    """Return the (width, height) of the frames of an image or a video file."""
+    if video:
+        infos = ffmpeg_parse_infos(video)
+        width, height = infos['video_size']
+        if infos.get('video_rotation', 0) in (90, 270):
+            width, height = height, width
+        return width, height
+    with Image.open(img) as image:
+        return image.size
+
+
+def open_writer(output, size, fps, **options):
+    """Return an FFmpegWriter for a path, or a FanoutWriter for a list of output specs."""
+    if isinstance(output, str):
+        return FFmpegWriter(output, size, fps, **options)
+    return FanoutWriter(output, size, fps, **options)
+
+
+def segment_frames(n_frames, n_segments):
+    """Split range(n_frames) into up to n_segments contiguous (start, end) ranges."""
+    bounds = np.linspace(0, n_frames, n_segments + 1).astype(int).tolist()
+    return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+
+def render_frames(writer, chain, frames, first_frame=0, workers=1, queue_size=8, release=None, telemetry=None):
+    """Render the source `frames` through `chain` into `writer`.
+
+    Source frames are read in order on the calling thread and the chain is
+    applied by `workers` threads, while a writer thread feeds the finished
+    frames to the encoder in order. At most `queue_size` frames are in
+    flight, so effects are computed while ffmpeg encodes the previous
+    frames and memory use stays bounded. Frames are rendered into a pool of
+    output buffers that go back to the pool once the writer is done with
+    them, so no frame is allocated beyond the ones in flight.
+
+    frames: Iterable of source frames, numbered from `first_frame`
+    release: Optional callable handing each source frame back to its reader
+        once the chain is done with it
+    telemetry: Optional Telemetry timing the decoding, processing and
+        encoding of every frame
+    """
+    telemetry = telemetry or NULL_TELEMETRY
+    pending = queue.Queue(queue_size)
+    buffers = queue.SimpleQueue()
+    errors = []
+
+    def process(frame, i):
+        try:
+            try:
+                out = buffers.get_nowait()
+            except queue.Empty:
+                out = np.empty(frame.shape, frame.dtype)
+            with telemetry.stage('frame'):
+                return chain.apply(frame, i, out=out)
+        finally:
+            if release is not None:
+                release(frame)
+
+    def consume():
+        while True:
+            future = pending.get()
+            if future is None:
+                return
+            if errors:
+                continue  # keep draining so the producer never blocks
+            try:
+                frame = future.result()
+                with telemetry.stage('encode'):
+                    writer.write_frame(frame, release=buffers.put)
+            except Exception as e:
+                errors.append(e)
+
+    consumer = threading.Thread(target=consume, daemon=True)
+    consumer.start()
+    try:
+        with ThreadPoolExecutor(workers) as executor:
+            frames = iter(frames)
+            for i in itertools.count(first_frame):
+                if errors:
+                    break
+                with telemetry.stage('decode'):
+                    frame = next(frames, None)
+                if frame is None:
+                    break
+                pending.put(executor.submit(process, frame, i))
+    finally:
+        pending.put(None)
+        consumer.join()
+    if errors:
+        raise errors[0]
+
+
+def render_segment(output, start_frame, end_frame, signals, img=None, video=None, spectrogram=None,
+                   frame_cache=None, cache_step=0.01, threads=None, audio=None, audio_start=0,
+                   render_threads=1, prefetch=8, effects=None, telemetry=None, scale=1, audio_samples=None,
+                   **encoder):
+    """Render frames [start_frame, end_frame) of the animation to a video file.
+
+    Also used in worker processes, so it rebuilds the source clip and the
+    effect chain from picklable arguments.
+
+    output: Path of the video, or a list of output specs (see FanoutWriter)
+        to encode the same frames into several videos at once
+
+    threads: Number of encoder threads
+    audio, audio_start: Optional file to mux audio from, see FFmpegWriter
+    audio_samples: Optional (samples, sample_rate) of decoded audio to mux
+        instead, see FFmpegWriter
+    render_threads: Number of threads applying the effects
+    prefetch: Number of video frames decoded ahead of the effects
+    effects: List of (effect, band) pairs, DEFAULT_EFFECTS by default
+    telemetry: Optional Telemetry timing every stage of the rendering
+    scale: Factor to resize the source by, e.g. for drafts. The effects are
+        used as given, see pipeline.scale_effects
+    encoder: Encoder options (codec, preset, crf, pix_fmt, ffmpeg_params)
+
+    Returns the (hits, misses) of the frame cache, or None without a cache.
+    """
+    fps = signals.fps
+    n_frames = end_frame - start_frame
+    if video:
+        # Frames are decoded ahead on a background thread into a fixed ring of buffers
+        source = FFmpegReader(video, fps, start_frame=start_frame, n_frames=n_frames,
+                              buffers=prefetch + render_threads, scale=scale)
+        frames, release = source, source.release
+    else:
+        source = load_clip(img=img, duration=len(signals) / fps, fps=fps, scale=scale)
+        frames = (source.get_frame(i / fps) for i in range(start_frame, end_frame))
+        release = None
+    width, height = source.size
+
+    cache = None
+    if frame_cache and not video:
+        cache = FrameCache(frame_cache * 2**20, step=cache_step)
+    overlay = None
+    if spectrogram is not None:
+        # The bars' padding is set in points, so it shrinks with the dpi
+        overlay = SpectrumOverlay(spectrogram, height=height, width=width, dpi=100 * scale)
+    telemetry = telemetry or NULL_TELEMETRY
+    chain = EffectChain(effects or DEFAULT_EFFECTS, signals, cache=cache, overlay=overlay, telemetry=telemetry)
+
+    try:
+        with open_writer(output, source.size, fps, threads=threads, audio=audio, audio_start=audio_start,
+                         duration=n_frames / fps, audio_samples=audio_samples, **encoder) as writer:
+            render_frames(writer, chain, frames, first_frame=start_frame,
+                          workers=render_threads, release=release, telemetry=telemetry)
+            # Closing waits for ffmpeg to encode the frames still in its buffers
+            with telemetry.stage('encode_finish'):
+                writer.close()
+    finally:
+        source.close()
+
+    if cache is not None:
+        telemetry.cache('frame', cache.hits, cache.misses)
+        return cache.hits, cache.misses
+
+
+def concat_segments(segments, output, audio=None, audio_start=0, duration=None):
+    """Join video segments without re-encoding using ffmpeg's concat demuxer.
+
+    If `audio` is given, `duration` seconds of it starting at `audio_start`
+    are encoded to AAC and muxed into the output.
+    """
+    list_path = output + '.segments.txt'
+    with open(list_path, 'w') as list_file:
+        for segment in segments:
+            path = os.path.abspath(segment).replace("'", "'\\''")
+            list_file.write(f"file '{path}'\n")
+
+    cmd = [get_setting('FFMPEG_BINARY'), '-y', '-f', 'concat', '-safe', '0', '-i', list_path]
+    if audio:
+        cmd += ['-ss', str(audio_start)]
+        if duration is not None:
+            cmd += ['-t', str(duration)]
+        cmd += ['-i', audio, '-map', '0:v', '-map', '1:a?', '-c:a', 'aac']
+    cmd += ['-c:v', 'copy', output]
+    try:
+        subprocess_call(cmd, logger=None)
+    finally:
+        os.remove(list_path)
+
+
+def _render_profiled_segment(*args, **kwargs):
+    """render_segment for a worker process, also returning the timings it recorded."""
+    telemetry = Telemetry()
+    result = render_segment(*args, telemetry=telemetry, **kwargs)
+    return result, telemetry.samples, telemetry.caches
+
+
+def render_parallel(output, signals, workers, img=None, video=None, spectrogram=None,
+                    audio=None, audio_start=0, frame_cache=None, cache_step=0.01, effects=None,
+                    telemetry=None, scale=1, **encoder):
+    """Render the animation in `workers` processes, one timeline segment each.
+
+    The segments share the same precomputed signals and are concatenated
+    losslessly, with the audio muxed in once at the end.
+
+    output: Path of the video, or a list of output specs (see FanoutWriter)
+    effects: List of (effect, band) pairs, DEFAULT_EFFECTS by default
+    telemetry: Optional Telemetry the timings of all the workers are added to
+    scale: Factor to resize the source by, see render_segment
+    encoder: Encoder options passed on to FFmpegWriter
+    """
+    telemetry = telemetry or NULL_TELEMETRY
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    # Workers time into their own Telemetry and send back what it recorded
+    target = _render_profiled_segment if telemetry.enabled else render_segment
+    segments = segment_frames(len(signals), workers)
+
+    specs = [{'output': output}] if isinstance(output, str) else output
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(specs[0]['output']))) as tmp_dir:
+        # The segments of every output, as a list of output specs per segment
+        parts = [
+            [dict(spec, output=os.path.join(tmp_dir, f'segment{k:04d}-{j}.mp4')) for j, spec in enumerate(specs)]
+            for k in range(len(segments))
+        ]
+        with ProcessPoolExecutor(workers) as executor:
+            futures = [
+                executor.submit(target, part[0]['output'] if isinstance(output, str) else part,
+                                start, end, signals,
+                                img=img, video=video, spectrogram=spectrogram,
+                                frame_cache=frame_cache, cache_step=cache_step,
+                                effects=effects, scale=scale, threads=threads, **encoder)
+                for part, (start, end) in zip(parts, segments)
+            ]
+            results = [future.result() for future in futures]
+        if telemetry.enabled:
+            for _, samples, caches in results:
+                telemetry.merge(samples, caches)
+            results = [result for result, _, _ in results]
+
+        with telemetry.stage('concat'):
+            for j, spec in enumerate(specs):
+                concat_segments([part[j]['output'] for part in parts], spec['output'],
+                                audio=audio, audio_start=audio_start, duration=len(signals) / signals.fps)
+
+    stats = [result for result in results if result is not None]
+    if stats:
+        print(hit_rate_report('Frame cache', *map(sum, zip(*stats))))
@@ -0,0 +1,86 @@
+import numpy as np
+
+
+def normalize(x):
+    """Scale an array to the 0-1 range (constant arrays become all zeros)."""
+    x = np.asarray(x, dtype=np.float32)
+    span = x.max() - x.min()
+    if span == 0:
+        return np.zeros_like(x)
+    return (x - x.min()) / span
+
+
+def nearest_index(times, query):
+    """Return the index of the nearest value in the sorted `times` for each query time."""
+    times = np.asarray(times)
+    query = np.asarray(query)
+    idx = np.clip(np.searchsorted(times, query), 1, len(times) - 1)
+    left, right = times[idx - 1], times[idx]
+    idx -= (query - left) < (right - query)
+    return idx
+
+
+class SignalTable:
+    """Per-frame effect signals with O(1) lookup.
+
+    Each band (e.g. 'low', 'high') is stored as a contiguous float32 array
+    holding one value per output frame.
+
+    fps: Frame rate the table is indexed at
+    bands: Band name to per-frame signal values
+    """
+
+    def __init__(self, fps, **bands):
+        self.fps = fps
+        self.bands = {
+            name: np.ascontiguousarray(values, dtype=np.float32)
+            for name, values in bands.items()
+        }
+
+    @classmethod
+    def from_activations(cls, times, frame_times, fps, **bands):
+        """Build a table from activations sampled at `times`.
+
+        Every band is normalized, resampled to the nearest analysis frame for
+        each of `frame_times` and normalized again.
+        """
+        idx = nearest_index(times, frame_times)
+        return cls(fps, **{
+            name: normalize(normalize(values)[idx])
+            for name, values in bands.items()
+        })
+
+    def __len__(self):
+        return len(next(iter(self.bands.values())))
+
+    def __getitem__(self, band):
+        return self.bands[band]
+
+    def frame_index(self, t):
+        """Return the frame number closest to time `t` (in seconds)."""
+        return min(max(int(round(t * self.fps)), 0), len(self) - 1)
+
+    def at_frame(self, band, i):
+        return self.bands[band][i]
+
+    def at_time(self, band, t):
+        return self.bands[band][self.frame_index(t)]
+
+    def resample_indices(self, fps):
+        """Return the frame of this table nearest to every frame of the same duration at `fps`."""
+        n_frames = int(np.ceil(len(self) * fps / self.fps - 1e-9))
+        return np.minimum(np.round(np.arange(n_frames) * self.fps / fps).astype(np.intp), len(self) - 1)
+
+    def resample(self, fps):
+        """Return a table of the same signals at another frame rate."""
+        idx = self.resample_indices(fps)
+        return SignalTable(fps, **{name: values[idx] for name, values in self.bands.items()})
+
+    def save(self, path):
+        np.savez(path, fps=self.fps, **self.bands)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            bands = {name: data[name] for name in data.files if name != 'fps'}
+            return cls(data['fps'].item(), **bands)
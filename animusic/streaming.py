@@ -0,0 +1,247 @@
+import subprocess
+import sys
+import time
+import librosa
+import numpy as np
+from PIL import Image
+from moviepy.config import get_setting
+from scipy.ndimage import median_filter
+from .analysis import frame_parameters, hpss_decimation, hpss_kernels, percussive_mask, stft_magnitude
+from .pipeline import EffectChain, resolve_effects
+from .writer import FFmpegWriter
+
+
+class PCMSource:
+    """Raw interleaved float32 samples read progressively from a binary stream.
+
+    stream: Readable binary file, e.g. stdin or the output of ffmpeg
+    sr: Sample rate of the samples
+    channels: Number of interleaved channels
+    proc: Optional process writing to `stream`, stopped by `close`
+    """
+
+    def __init__(self, stream, sr, channels=2, proc=None):
+        self.stream = stream
+        self.sr = sr
+        self.channels = channels
+        self.proc = proc
+
+    def read(self, n):
+        """Return the next `n` samples as a (channels, n) float32 array.
+
+        Blocks until they're available. Near the end of the stream fewer
+        samples are returned, and None once it's exhausted.
+        """
+        size = n * self.channels * 4
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.stream.read(size - len(data))
+            if not chunk:
+                break
+            data += chunk
+        data = data[:len(data) - len(data) % (self.channels * 4)]
+        if not data:
+            return None
+        return np.frombuffer(bytes(data), np.float32).reshape(-1, self.channels).T
+
+    def close(self):
+        if self.proc is not None:
+            self.proc.kill()
+            self.proc.wait()
+            self.stream.close()
+
+
+def open_audio_stream(path, sr=44100, channels=2):
+    """Return a PCMSource decoding `path` progressively, as it's read.
+
+    path: Audio file or URL decoded with ffmpeg, or '-' for raw interleaved
+        float32 samples at `sr` on stdin
+    """
+    if path == '-':
+        return PCMSource(sys.stdin.buffer, sr, channels)
+    cmd = [get_setting('FFMPEG_BINARY'), '-loglevel', 'error', '-i', path,
+           '-vn', '-f', 'f32le', '-acodec', 'pcm_f32le', '-ac', str(channels), '-ar', str(sr), '-']
+    proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE)
+    return PCMSource(proc.stdout, sr, channels, proc=proc)
+
+
+def default_templates(sr, n_mels=128):
+    """Return fixed (n_mels, 2) spectral templates for the low and high bands.
+
+    The low template covers the kick and bass range, the high one the
+    snares and hi-hats, like the two sorted NMF components of a typical
+    track.
+    """
+    freqs = librosa.mel_frequencies(n_mels=n_mels, fmax=sr / 2)
+    low = np.exp(-freqs / 150)
+    high = 1 - np.exp(-freqs / 3000)
+    templates = np.stack([low, high], axis=1)
+    return templates / templates.sum(axis=0)
+
+
+def learn_templates(y, sr, fps=30, frame_smoothing=3):
+    """Return the (n_mels, 2) NMF components of a reference track as templates.
+
+    They're computed like the offline analysis does, so a live set can be
+    analysed with the components of a similar recording.
+    """
+    hop_length, win_length, n_fft = frame_parameters(sr, fps, frame_smoothing)
+    X = stft_magnitude(y, n_fft, hop_length, win_length)
+    mask = percussive_mask(X, *hpss_kernels(hop_length, n_fft), decimation=hpss_decimation(n_fft))
+    S = librosa.filters.mel(sr=sr, n_fft=n_fft) @ (X * mask)
+    components, _ = librosa.decompose.decompose(S, n_components=2, sort=True)
+    return components / np.maximum(components.sum(axis=0), 1e-10)
+
+
+class RunningNormalizer:
+    """Scale values to 0-1 by a running minimum and maximum that slowly forget.
+
+    memory: Roughly how many updates the extremes are remembered for
+    """
+
+    def __init__(self, memory):
+        self.decay = np.exp(-1 / memory)
+        self.low = None
+        self.high = None
+
+    def __call__(self, x):
+        if self.low is None:
+            self.low, self.high = x.copy(), x.copy()
+        # The extremes drift towards the current value unless it pushes them out
+        self.low = np.minimum(x, x + (self.low - x) * self.decay)
+        self.high = np.maximum(x, x + (self.high - x) * self.decay)
+        span = self.high - self.low
+        return np.where(span > 0, (x - self.low) / np.where(span > 0, span, 1), 0)
+
+
+class CausalAnalyzer:
+    """Compute the low and high band signals frame by frame, from past audio only.
+
+    A streaming counterpart of analysis.analyze: every video frame, the last
+    window of audio is transformed once and split into harmonic and
+    percussive parts by median filtering in the spectral domain (the
+    harmonic estimate only looks at past frames). The percussive mel
+    spectrum is then projected onto fixed templates instead of running NMF
+    over the whole track, and the activations are normalized by running
+    extremes instead of the track's.
+
+    sr: Sample rate of the audio
+    fps: Frame rate of the video, one update per frame
+    frame_smoothing: Length of the analysis window in frames
+    templates: (n_mels, 2) low and high templates, default_templates by default
+    harmonic_frames: Number of past frames of the harmonic median filter
+    percussive_width: Width in Hz of the percussive median filter
+    memory: Seconds the running normalization remembers extremes for
+    """
+
+    bands = ('low', 'high')
+
+    def __init__(self, sr, fps, frame_smoothing=3, templates=None, harmonic_frames=17, percussive_width=300, memory=10):
+        self.hop_length, self.win_length, self.n_fft = frame_parameters(sr, fps, frame_smoothing)
+        self.window = librosa.filters.get_window('blackman', self.win_length).astype(np.float32)
+        self.templates = default_templates(sr) if templates is None else np.asarray(templates)
+        self.mel = librosa.filters.mel(sr=sr, n_fft=self.n_fft, n_mels=self.templates.shape[0])
+        self.percussive_bins = int(percussive_width / (sr / self.n_fft)) | 1
+        self._buffer = np.zeros(self.win_length, dtype=np.float32)
+        self._history = np.zeros((harmonic_frames, self.n_fft // 2 + 1), dtype=np.float32)
+        self._frames = 0
+        self._activations = np.full(self.templates.shape[1], 1e-3)
+        self._gram = self.templates.T @ self.templates
+        self._normalize = RunningNormalizer(memory * fps)
+
+    def process(self, y):
+        """Add the mono samples of the next frame and return {band: signal}."""
+        self._buffer = np.concatenate([self._buffer, y])[-self.win_length:]
+        X = np.abs(np.fft.rfft(self._buffer * self.window, n=self.n_fft)).astype(np.float32)
+
+        self._history[self._frames % len(self._history)] = X
+        self._frames += 1
+        harmonic = np.median(self._history[:min(self._frames, len(self._history))], axis=0)
+        percussive = median_filter(X, size=self.percussive_bins, mode='nearest')
+        # Same soft mask as librosa's hpss with margin=1
+        mask = percussive ** 2 / np.maximum(percussive ** 2 + harmonic ** 2, 1e-20)
+        S = self.mel @ (X * mask)
+
+        # Non-negative least squares of S on the templates, warm-started from the last frame
+        h = self._activations
+        projection = self.templates.T @ S
+        for _ in range(20):
+            h = h * projection / np.maximum(self._gram @ h, 1e-10)
+        self._activations = np.maximum(h, 1e-10)
+        return dict(zip(self.bands, self._normalize(h).tolist()))
+
+
+class LiveSignals:
+    """The latest value of every band, looked up by EffectChain like a SignalTable."""
+
+    def __init__(self, fps, bands):
+        self.fps = fps
+        self.values = dict.fromkeys(bands, 0.0)
+
+    def update(self, values):
+        self.values.update(values)
+
+    def at_frame(self, band, i):
+        return self.values[band]
+
+    def frame_index(self, t):
+        return int(round(t * self.fps))
+
+
+def stream_animation(img, audio, output, fps=30, sample_rate=44100, channels=2, effects=None, frame_smoothing=3,
+                     templates=None, realtime=None, codec='libx264', preset='ultrafast', crf=None, bitrate=None,
+                     format=None):
+    """Animate an image from audio as it comes in and stream the result.
+
+    Audio is consumed one frame's worth of samples at a time, analysed
+    causally with CausalAnalyzer and muxed, with the effected frame, into
+    an ffmpeg output tuned for low latency. The signals lag the audio by
+    about half the analysis window (frame_smoothing / fps / 2), and the
+    encoder adds about a frame.
+
+    img: Image to animate
+    audio: Audio file or URL, or '-' to read raw interleaved float32 samples
+        at `sample_rate` from stdin (e.g. piped from a live input)
+    output: Video file, or a streaming URL such as rtmp://...
+    realtime: Emit frames at playback rate. By default on, except for stdin,
+        which already arrives at playback rate
+    format: Output container, 'flv' by default for rtmp:// URLs
+    """
+    if format is None and output.startswith('rtmp'):
+        format = 'flv'
+    if realtime is None:
+        realtime = audio != '-'
+
+    frame = np.array(Image.open(img).convert('RGB'))
+    # Most encoders need even frame sizes
+    frame = np.ascontiguousarray(frame[:frame.shape[0] // 2 * 2, :frame.shape[1] // 2 * 2])
+    height, width = frame.shape[:2]
+
+    analyzer = CausalAnalyzer(sample_rate, fps, frame_smoothing=frame_smoothing, templates=templates)
+    signals = LiveSignals(fps, analyzer.bands)
+    chain = EffectChain(resolve_effects(effects), signals)
+
+    source = open_audio_stream(audio, sample_rate, channels)
+    ffmpeg_params = ['-tune', 'zerolatency'] if codec == 'libx264' else []
+    try:
+        with FFmpegWriter(output, (width, height), fps, codec=codec, preset=preset, crf=crf, bitrate=bitrate,
+                          ffmpeg_params=ffmpeg_params, audio_format=(sample_rate, channels), format=format) as writer:
+            start = time.perf_counter()
+            position = 0
+            i = 0
+            while True:
+                # Frames don't always span a whole number of samples, so round the frame boundaries
+                block = source.read(int(round((i + 1) * sample_rate / fps)) - position)
+                if block is None:
+                    break
+                position += block.shape[1]
+                signals.update(analyzer.process(block.mean(axis=0)))
+                writer.write_audio(block)
+                writer.write_frame(chain.apply(frame, i))
+                i += 1
+                if realtime:
+                    delay = start + i / fps - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+    finally:
+        source.close()
@@ -0,0 +1,144 @@
+import json
+import sys
+import threading
+import time
+import numpy as np
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def peak_rss():
+    """Return the peak resident set size in bytes of this process and of its children.
+
+    The children are the finished subprocesses, e.g. render workers and
+    ffmpeg. Returns None where it can't be measured.
+    """
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux but in bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return {
+        'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+        'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale,
+    }
+
+
+class Telemetry:
+    """Record how long every stage of a render takes.
+
+    Stages are timed with `stage` (or `record`ed directly) and can run many
+    times, e.g. once per frame, from any thread. `report` summarizes them
+    with totals and latency percentiles, together with the peak memory use
+    and the hit rates of the caches.
+
+    callback: Optional callable callback(stage, seconds) called for every
+        timing as it's recorded, e.g. to feed a metrics system. It's called
+        on the thread that ran the stage, so it should be quick.
+    """
+
+    enabled = True
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.samples = {}
+        self.caches = {}
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name):
+        """Context manager timing the code it wraps as one run of stage `name`."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name, seconds):
+        with self._lock:
+            self.samples.setdefault(name, []).append(seconds)
+        if self.callback is not None:
+            self.callback(name, seconds)
+
+    def cache(self, name, hits, misses):
+        """Add the hits and misses of a cache."""
+        with self._lock:
+            total = self.caches.setdefault(name, [0, 0])
+            total[0] += hits
+            total[1] += misses
+
+    def merge(self, samples, caches=None):
+        """Add the timings and cache counts recorded by another Telemetry, e.g. in a worker process."""
+        for name, values in samples.items():
+            for seconds in values:
+                self.record(name, seconds)
+        for name, (hits, misses) in (caches or {}).items():
+            self.cache(name, hits, misses)
+
+    def report(self):
+        """Return a JSON-serializable summary of everything recorded so far."""
+        with self._lock:
+            samples = {name: np.array(values) for name, values in self.samples.items()}
+            caches = dict(self.caches)
+        stages = {}
+        for name, values in samples.items():
+            p50, p90, p99 = np.percentile(values, [50, 90, 99])
+            stages[name] = {
+                'count': len(values),
+                'total': float(values.sum()),
+                'mean': float(values.mean()),
+                'p50': float(p50),
+                'p90': float(p90),
+                'p99': float(p99),
+                'max': float(values.max()),
+            }
+        return {
+            'wall_time': time.perf_counter() - self._start,
+            'stages': stages,
+            'caches': {
+                name: {'hits': hits, 'misses': misses, 'hit_rate': hits / (hits + misses) if hits + misses else 0.0}
+                for name, (hits, misses) in caches.items()
+            },
+            'peak_rss': peak_rss(),
+        }
+
+    def save(self, path):
+        """Write the report to a JSON file."""
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+
+class NullTelemetry:
+    """Telemetry that records nothing, used when profiling is disabled."""
+
+    enabled = False
+
+    def stage(self, name):
+        return _NULL_STAGE
+
+    def record(self, name, seconds):
+        pass
+
+    def cache(self, name, hits, misses):
+        pass
+
+    def merge(self, samples, caches=None):
+        pass
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+# Shared instance used wherever no telemetry is given
+NULL_TELEMETRY = NullTelemetry()
@@ -0,0 +1,113 @@
+import numpy as np
+
+
+def hex_to_rgb(color):
+    color = color.lstrip('#')
+    return tuple(int(color[i:i+2], 16) for i in (0, 2, 4))
+
+
+class BarVisualizer:
+    """Rasterize a bar spectrum directly into RGBA arrays with NumPy.
+
+    The layout matches the matplotlib bar plot `draw_visualizer` used to
+    produce (tight layout with the axis hidden, default bar width and x
+    margins, y axis fixed to [0, 1]) without going through matplotlib.
+
+    n_bars: Number of bars (spectrum bins)
+    height, width: Size of the frames in pixels
+    color: Bar color as a hex string
+    scale: Factor applied to the spectrum values to get bar heights
+    dpi: Resolution the matplotlib layout is computed at (affects the padding)
+    """
+
+    def __init__(self, n_bars, height, width, color='#ab20fd', scale=0.2, dpi=100):
+        self.n_bars = n_bars
+        self.height = height
+        self.width = width
+        self.color = np.array(hex_to_rgb(color) + (255,), dtype=np.uint8)
+        self.scale = scale
+
+        # tight_layout pads the axes by 1.08 font sizes (10pt) on every side
+        pad = 1.08 * 10 / 72 * dpi
+        self.top, self.bottom = int(round(pad)), int(round(height - pad))
+        left, right = pad, width - pad
+
+        # Bars are 0.8 wide and centered on 0..n_bars-1, with 5% x margins
+        x0, x1 = -0.4, n_bars - 1 + 0.4
+        margin = 0.05 * (x1 - x0)
+        x0, x1 = x0 - margin, x1 + margin
+        edges = np.arange(n_bars)[:, None] + np.array([-0.4, 0.4])
+        edges = np.round(left + (edges - x0) / (x1 - x0) * (right - left)).astype(int)
+        edges = np.clip(edges, 0, width)
+
+        # Bar index of every pixel column, n_bars for columns between bars
+        self.column_bars = np.full(width, n_bars, dtype=np.intp)
+        for i, (start, stop) in enumerate(edges):
+            self.column_bars[start:stop] = i
+        self._rows = np.arange(self.bottom)[:, None]
+
+    def column_tops(self, S):
+        """Return the top pixel row of the bar covering every pixel column.
+
+        Columns without a bar get `self.bottom`, i.e. an empty bar.
+
+        S: Array of shape (n_bars,) or (n_frames, n_bars)
+        """
+        levels = np.clip(np.asarray(S) * self.scale, 0, 1)
+        tops = np.round(self.bottom - levels * (self.bottom - self.top)).astype(np.intp)
+        tops = np.concatenate([tops, np.full(tops.shape[:-1] + (1,), self.bottom)], axis=-1)
+        return tops[..., self.column_bars]
+
+    def mask(self, S):
+        """Return a boolean (..., bottom, width) mask of the bar pixels.
+
+        Rows from `self.bottom` down never contain bars and are left out.
+        """
+        return self._rows >= self.column_tops(S)[..., None, :]
+
+    def draw(self, S, out=None):
+        """Return RGBA frame(s) of the bars for spectrum frame(s) S.
+
+        S: Array of shape (n_bars,) for a single frame or (n_frames, n_bars)
+            to render a whole batch at once
+        out: Optional contiguous uint8 array of shape (..., height, width, 4)
+        """
+        S = np.asarray(S)
+        if out is None:
+            out = np.empty(S.shape[:-1] + (self.height, self.width, 4), dtype=np.uint8)
+        # Every RGBA pixel is written as a single uint32: the bar color or 0
+        pixels = out.view(np.uint32)[..., 0]
+        np.multiply(self.mask(S), self.color.view(np.uint32)[0], out=pixels[..., :self.bottom, :])
+        pixels[..., self.bottom:, :] = 0
+        return out
+
+    def composite(self, frame, S):
+        """Draw the bars for spectrum frame S onto an RGB(A) frame in place.
+
+        The bars are opaque, so compositing them is a masked copy of the color.
+        """
+        region = frame[:self.bottom]
+        np.copyto(region, self.color[:frame.shape[-1]], where=self.mask(S)[..., None])
+        return frame
+
+
+class SpectrumOverlay:
+    """Draw the visualizer for each frame on demand from its spectrogram column.
+
+    Nothing is rendered ahead of time, so memory use doesn't depend on the
+    length of the video.
+
+    S: Spectrogram of shape (n_bars, n_frames), normalized to 0-1
+    height, width: Size of the frames in pixels
+    options: Extra BarVisualizer options (color, scale, dpi)
+    """
+
+    def __init__(self, S, height, width, **options):
+        self.S = S
+        self.visualizer = BarVisualizer(S.shape[0], height, width, **options)
+
+    def __call__(self, frame, i):
+        """Draw the bars of frame number `i` onto `frame` in place."""
+        if i < self.S.shape[1]:
+            self.visualizer.composite(frame, self.S[:, i])
+        return frame
@@ -0,0 +1,403 @@
+import os
+import queue
+import subprocess
+import tempfile
+import threading
+import numpy as np
+from moviepy.config import get_setting
+
+
+# Extra x264 options used unless other ffmpeg_params are given
+X264_PARAMS = ['-bf', '2', '-b_strategy', '2']
+
+
+class FFmpegWriter:
+    """Encode raw RGB frames by piping them to an ffmpeg subprocess.
+
+    output: Path of the video file to write
+    size: (width, height) of the frames
+    fps: Frame rate of the video
+    codec: ffmpeg video encoder
+    preset: Encoder preset, or None for the encoder's default
+    crf: Constant rate factor, or None for the encoder's default
+    pix_fmt: Output pixel format. By default yuv420p when the frame size is
+        even (as required by most players), otherwise the encoder's choice
+    threads: Number of encoder threads, or None to let ffmpeg decide
+    audio: Optional media file whose audio is muxed into the output
+    audio_start: Time in seconds the muxed audio starts from
+    duration: Length in seconds of the muxed audio
+    ffmpeg_params: Extra output options, X264_PARAMS by default for libx264
+    bitrate: Target video bitrate (e.g. '8M'), or None to rely on the crf
+    filters: Optional ffmpeg filter graph applied to the frames, e.g. to
+        crop or scale them. The output size must then be even for yuv420p.
+    audio_format: (sample_rate, channels) to mux audio passed to
+        `write_audio` instead of reading it from a file (POSIX only)
+    audio_samples: Optional (samples, sample_rate) of already decoded audio
+        of shape (channels, n_samples) to mux, fed through the same pipe as
+        `audio_format` so the file isn't decoded again (POSIX only)
+    format: Output container format, e.g. 'flv' for RTMP, by default
+        guessed from the output name
+    """
+
+    def __init__(self, output, size, fps, codec='libx264', preset='medium', crf=None, pix_fmt=None,
+                 threads=None, audio=None, audio_start=0, duration=None, ffmpeg_params=None,
+                 bitrate=None, filters=None, audio_format=None, format=None, audio_samples=None):
+        width, height = size
+        self.output = output
+        self.frame_bytes = width * height * 3
+        if pix_fmt is None and (filters or not (width % 2 or height % 2)):
+            pix_fmt = 'yuv420p'
+        if ffmpeg_params is None:
+            ffmpeg_params = X264_PARAMS if codec == 'libx264' else []
+
+        cmd = [
+            get_setting('FFMPEG_BINARY'), '-y', '-loglevel', 'error',
+            '-f', 'rawvideo', '-vcodec', 'rawvideo', '-s', f'{width}x{height}',
+            '-pix_fmt', 'rgb24', '-r', f'{fps:.02f}', '-i', '-',
+        ]
+        if audio:
+            cmd += ['-ss', str(audio_start)]
+            if duration is not None:
+                cmd += ['-t', str(duration)]
+            cmd += ['-i', audio, '-map', '0:v', '-map', '1:a?', '-c:a', 'aac']
+        pass_fds = ()
+        self._audio = None
+        self._audio_thread = None
+        self._frames = None
+        self._video_thread = None
+        self._errors = []
+        if audio_samples is not None:
+            audio_format = (audio_samples[1], audio_samples[0].shape[0])
+        if audio_format:
+            # Raw float samples come through a second pipe, fed by a thread so
+            # that ffmpeg waiting for either input can never block the other.
+            # Their format is given, so don't let ffmpeg buffer seconds of them
+            # to probe it before reading any more video.
+            sample_rate, channels = audio_format
+            read_fd, write_fd = os.pipe()
+            pass_fds = (read_fd,)
+            cmd += ['-probesize', '32', '-analyzeduration', '0',
+                    '-f', 'f32le', '-ar', str(sample_rate), '-ac', str(channels), '-i', f'pipe:{read_fd}',
+                    '-map', '0:v', '-map', '1:a', '-c:a', 'aac']
+        if filters:
+            cmd += ['-vf', filters]
+        cmd += ['-c:v', codec]
+        if bitrate:
+            cmd += ['-b:v', str(bitrate)]
+        if preset:
+            cmd += ['-preset', preset]
+        if crf is not None:
+            cmd += ['-crf', str(crf)]
+        if threads:
+            cmd += ['-threads', str(threads)]
+        cmd += list(ffmpeg_params)
+        if pix_fmt:
+            cmd += ['-pix_fmt', pix_fmt]
+        if format:
+            cmd += ['-f', format]
+        cmd.append(output)
+
+        # A file rather than a pipe, so a chatty ffmpeg can never block on stderr
+        self._log = tempfile.TemporaryFile()
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=self._log,
+                                     pass_fds=pass_fds)
+        if audio_format:
+            os.close(read_fd)
+            self._audio_pipe = os.fdopen(write_fd, 'wb')
+            if audio_samples is not None:
+                blocks = self._sample_blocks(*audio_samples)
+            else:
+                self._audio = queue.Queue(maxsize=16)
+                blocks = iter(self._audio.get, None)
+                # ffmpeg interleaves the two inputs and only reads a frame once
+                # it has the audio up to it, so frames are written by a thread
+                # of their own and the audio written with them can run ahead
+                self._frames = queue.Queue(maxsize=16)
+                self._video_thread = threading.Thread(target=self._feed_frames, daemon=True)
+                self._video_thread.start()
+            self._audio_thread = threading.Thread(target=self._feed_audio, args=(blocks,), daemon=True)
+            self._audio_thread.start()
+
+    @staticmethod
+    def _sample_blocks(samples, sample_rate):
+        """Yield decoded samples as interleaved float32 bytes, a second at a time."""
+        for start in range(0, samples.shape[1], sample_rate):
+            yield np.ascontiguousarray(samples[:, start:start + sample_rate].T, dtype=np.float32).tobytes()
+
+    def _feed_audio(self, blocks):
+        failed = False
+        for samples in blocks:
+            if failed:
+                continue  # keep draining so write_audio never blocks
+            try:
+                self._audio_pipe.write(samples)
+            except (BrokenPipeError, OSError):
+                if self._audio is None:
+                    break  # nothing waits on decoded samples
+                failed = True  # ffmpeg exited, close() reports why
+        try:
+            self._audio_pipe.close()
+        except (BrokenPipeError, OSError):
+            pass
+
+    def _feed_frames(self):
+        while True:
+            frame = self._frames.get()
+            if frame is None:
+                return
+            if self._errors:
+                continue  # keep draining so write_frame never blocks
+            try:
+                self._write(frame)
+            except IOError as e:
+                self._errors.append(e)
+
+    def _error(self):
+        self._log.seek(0)
+        return IOError(f'ffmpeg failed to write {self.output}:\n' + self._log.read().decode('utf8', 'replace'))
+
+    def _write(self, data):
+        try:
+            self.proc.stdin.write(data)
+        except (BrokenPipeError, OSError):
+            self.proc.wait()
+            raise self._error() from None
+
+    def write_frame(self, frame, release=None):
+        """Write a contiguous (height, width, 3) uint8 frame.
+
+        With `audio_format`, the frame is copied and queued, so it can be
+        modified as soon as this returns.
+
+        release: Optional callable called with the frame once it's written
+            and can be reused, see FanoutWriter.write_frame
+        """
+        if frame.nbytes != self.frame_bytes:
+            raise ValueError(f'Expected a frame of {self.frame_bytes} bytes, got {frame.nbytes}')
+        if self._frames is None:
+            self._write(memoryview(frame).cast('B'))
+        elif self._errors:
+            raise self._errors[0]
+        else:
+            self._frames.put(frame.tobytes())
+        if release is not None:
+            release(frame)
+
+    def write_audio(self, samples):
+        """Queue a block of samples of shape (channels, n_samples) for muxing, see `audio_format`."""
+        self._audio.put(np.ascontiguousarray(samples.T, dtype=np.float32).tobytes())
+
+    def close(self):
+        """Finish encoding and wait for ffmpeg to exit. Closing again does nothing."""
+        if self._log.closed:
+            return
+        if self._audio is not None:
+            self._audio.put(None)
+        if self._video_thread is not None:
+            self._frames.put(None)
+            self._video_thread.join()
+            self._video_thread = None
+            self._frames = None
+        if self.proc.stdin and not self.proc.stdin.closed:
+            try:
+                self.proc.stdin.close()
+            except BrokenPipeError:
+                pass
+        if self._audio_thread is not None:
+            # After the video ends, so ffmpeg can't be stuck waiting for a frame
+            self._audio_thread.join()
+            self._audio_thread = None
+            self._audio = None
+        returncode = self.proc.wait()
+        try:
+            if returncode:
+                raise self._error()
+        finally:
+            self._log.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            # Don't mask the original error with ffmpeg's
+            try:
+                self.close()
+            except IOError:
+                pass
+
+
+def _even(length):
+    return max(2, int(round(length / 2)) * 2)
+
+
+def parse_aspect(aspect):
+    """Return an aspect ratio given as a number or a 'width:height' string as a float."""
+    if isinstance(aspect, str):
+        width, height = aspect.split(':')
+        return float(width) / float(height)
+    return float(aspect)
+
+
+def output_geometry(size, aspect=None, width=None, height=None):
+    """Return how a frame of `size` is cropped and scaled for an output.
+
+    The frame is center-cropped to `aspect` (if given) and scaled to
+    `width` x `height`. A missing dimension follows from the other one and
+    the crop, and without either the crop keeps its size. Output
+    dimensions are rounded to even numbers.
+
+    Returns ((crop_width, crop_height, x, y), (width, height)).
+    """
+    source_width, source_height = size
+    crop_width, crop_height = source_width, source_height
+    if aspect:
+        ratio = parse_aspect(aspect)
+        if source_width / source_height > ratio:
+            crop_width = min(source_width, int(round(source_height * ratio)))
+        else:
+            crop_height = min(source_height, int(round(source_width / ratio)))
+    if width is None and height is None:
+        width, height = crop_width, crop_height
+    elif width is None:
+        width = height * crop_width / crop_height
+    elif height is None:
+        height = width * crop_height / crop_width
+    crop = (crop_width, crop_height, (source_width - crop_width) // 2, (source_height - crop_height) // 2)
+    return crop, (_even(width), _even(height))
+
+
+def output_scale(size, spec):
+    """Return the ratio of an output's resolution to that of the frames it's cut from."""
+    (crop_width, crop_height, _, _), (width, height) = output_geometry(
+        size, spec.get('aspect'), spec.get('width'), spec.get('height'))
+    return max(width / crop_width, height / crop_height)
+
+
+class FanoutWriter:
+    """Encode the same frames into several outputs at once.
+
+    Every output has its own ffmpeg process, which crops, scales and
+    resamples the frames and encodes them with its own settings. Frames are
+    handed to each encoder by a thread of its own through a small queue, so
+    the encoders run concurrently and a slow one doesn't stall the others
+    more than the queue allows. The frames are shared and must not be
+    modified after they're written.
+
+    outputs: List of output specs, dicts with the keys
+        output: Path of the video file (required)
+        aspect: Aspect ratio to center-crop to, e.g. '9:16' or 1
+        width, height: Size to scale to, see output_geometry
+        fps: Frame rate, by default that of the frames
+        and any FFmpegWriter encoder option (codec, preset, crf, bitrate,
+        pix_fmt, ffmpeg_params) overriding the defaults
+    size: (width, height) of the frames written
+    fps: Frame rate of the frames written
+    queue_size: Number of frames each output can fall behind
+    defaults: FFmpegWriter options used for every output (e.g. audio or
+        encoder settings) unless its spec overrides them
+    """
+
+    def __init__(self, outputs, size, fps, queue_size=4, **defaults):
+        self.outputs = [spec['output'] for spec in outputs]
+        self.writers = []
+        self._queues = []
+        self._threads = []
+        self._errors = []
+        try:
+            for spec in outputs:
+                spec = dict(spec)
+                output = spec.pop('output')
+                (crop_width, crop_height, x, y), (width, height) = output_geometry(
+                    size, spec.pop('aspect', None), spec.pop('width', None), spec.pop('height', None))
+                filters = [f'crop={crop_width}:{crop_height}:{x}:{y}', f'scale={width}:{height}']
+                output_fps = spec.pop('fps', None)
+                if output_fps and output_fps != fps:
+                    filters.append(f'fps={output_fps}')
+                options = {**defaults, **{key: value for key, value in spec.items() if value is not None}}
+                self.writers.append(FFmpegWriter(output, size, fps, filters=','.join(filters), **options))
+        except Exception:
+            # Don't leave the encoders that did start running
+            for writer in self.writers:
+                writer.proc.kill()
+                try:
+                    writer.close()
+                except IOError:
+                    pass
+            raise
+
+        for writer in self.writers:
+            frames = queue.Queue(queue_size)
+            thread = threading.Thread(target=self._feed, args=(writer, frames), daemon=True)
+            thread.start()
+            self._queues.append(frames)
+            self._threads.append(thread)
+
+    def _feed(self, writer, frames):
+        while True:
+            item = frames.get()
+            if item is None:
+                return
+            frame, done = item
+            # Once an output failed, keep draining so write_frame never blocks
+            if not self._errors:
+                try:
+                    writer.write_frame(frame)
+                except Exception as e:
+                    self._errors.append(e)
+            if done is not None:
+                done()
+
+    def write_frame(self, frame, release=None):
+        """Write a contiguous (height, width, 3) uint8 frame to every output.
+
+        release: Optional callable called with the frame once every output
+            has written it, so it can be reused
+        """
+        if self._errors:
+            raise self._errors[0]
+        done = None
+        if release is not None:
+            remaining = [len(self._queues)]
+            lock = threading.Lock()
+
+            def done():
+                with lock:
+                    remaining[0] -= 1
+                    if remaining[0]:
+                        return
+                release(frame)
+
+        for frames in self._queues:
+            frames.put((frame, done))
+
+    def close(self):
+        """Finish encoding every output and wait for the encoders to exit."""
+        for frames in self._queues:
+            frames.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._queues = []
+        self._threads = []
+        for writer in self.writers:
+            try:
+                writer.close()
+            except IOError as e:
+                self._errors.append(e)
+        if self._errors:
+            raise self._errors[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            # Don't mask the original error with ffmpeg's
+            try:
+                self.close()
+            except IOError:
+                pass
@@ -21,14 +21,16 @@ setuptools.setup(
     py_modules=['animusic'],
     install_requires=[
         'numpy',
-        'pandas',
-        'matplotlib',
         'PySimpleGUI',
         'Pillow',
         'moviepy',
         'librosa',
-        'tqdm'
+        'scipy',
+        'soundfile',
     ],
+    extras_require={
+        'matplotlib': ['matplotlib'],
+    },
     python_requires='>=3.6',
     entry_points={
         'console_scripts': [
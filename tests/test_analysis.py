@@ -0,0 +1,74 @@
+import librosa
+import numpy as np
+import pytest
+from scipy.ndimage import median_filter
+from animusic import analysis
+
+
+def synth_spectrogram(n_features=40, n_frames=300, seed=0):
+    """Return a non-negative spectrogram with repeating structure, like music."""
+    rng = np.random.default_rng(seed)
+    t = np.arange(n_frames)
+    pattern = (np.sin(t / 7)[None] * np.linspace(0, 2, n_features)[:, None]) ** 2
+    return (np.abs(rng.standard_normal((n_features, n_frames))) + pattern).astype(np.float32)
+
+
+@pytest.mark.parametrize('block_size', [1024, 64, 7])
+def test_windowed_nn_filter_matches_librosa_over_the_whole_track(block_size):
+    S = synth_spectrogram()
+    rec = librosa.segment.recurrence_matrix(S, mode='affinity', metric='cosine', sparse=True)
+    expected = librosa.decompose.nn_filter(S, rec=rec, aggregate=np.average)
+    result = analysis.windowed_nn_filter(S, horizon=S.shape[1], block_size=block_size)
+    np.testing.assert_allclose(result, expected, rtol=1e-4, atol=1e-5)
+
+
+def test_windowed_nn_filter_with_a_short_horizon_stays_close():
+    S = synth_spectrogram(n_frames=600)
+    rec = librosa.segment.recurrence_matrix(S, mode='affinity', metric='cosine', sparse=True)
+    expected = librosa.decompose.nn_filter(S, rec=rec, aggregate=np.average)
+    result = analysis.windowed_nn_filter(S, horizon=100)
+    assert np.all(np.isfinite(result))
+    assert np.corrcoef(result.ravel(), expected.ravel())[0, 1] > 0.9
+
+
+@pytest.mark.parametrize('horizon', [0, -3])
+def test_windowed_nn_filter_rejects_an_empty_horizon(horizon):
+    with pytest.raises(ValueError):
+        analysis.windowed_nn_filter(synth_spectrogram(), horizon=horizon)
+
+
+def test_windowed_nn_filter_single_frame():
+    S = synth_spectrogram(n_frames=1)
+    assert np.array_equal(analysis.windowed_nn_filter(S, horizon=1), S)
+
+
+def reference_percussive_mask(X, harmonic_size, percussive_size):
+    """The soft mask of librosa's HPSS, with two-dimensional median filters over X whole."""
+    harmonic = median_filter(X, size=(1, harmonic_size))
+    percussive = median_filter(X, size=(percussive_size, 1))
+    return librosa.util.softmask(percussive, harmonic, power=2)
+
+
+@pytest.mark.parametrize('workers, band_size', [(1, 64), (4, 64), (3, 7), (2, 1000)])
+@pytest.mark.parametrize('harmonic_size, percussive_size', [(11, 31), (1, 5), (23, 63)])
+def test_percussive_mask_matches_two_dimensional_filters(workers, band_size, harmonic_size, percussive_size):
+    X = synth_spectrogram(n_features=129, n_frames=97)
+    expected = reference_percussive_mask(X, harmonic_size, percussive_size)
+    result = analysis.percussive_mask(X, harmonic_size, percussive_size, workers=workers, band_size=band_size)
+    assert np.array_equal(result, expected)
+
+
+@pytest.mark.parametrize('decimation, coarse_size', [(2, 17), (4, 9)])
+def test_percussive_mask_decimation_repeats_the_mask_of_averaged_bins(decimation, coarse_size):
+    X = synth_spectrogram(n_features=4 * 32 + 1, n_frames=50)
+    result = analysis.percussive_mask(X, 11, 31, decimation=decimation)
+    assert result.shape == X.shape
+    # The last group holds the single leftover bin
+    coarse = np.concatenate([X[:-1].reshape(-1, decimation, X.shape[1]).mean(axis=1), X[-1:]])
+    expected = reference_percussive_mask(coarse, 11, coarse_size)
+    np.testing.assert_allclose(result, np.repeat(expected, decimation, axis=0)[:len(X)], rtol=1e-5)
+
+
+@pytest.mark.parametrize('n_fft, decimation', [(2048, 1), (1024, 1), (4096, 2), (8192, 4)])
+def test_hpss_decimation_pools_down_to_librosas_resolution(n_fft, decimation):
+    assert analysis.hpss_decimation(n_fft) == decimation
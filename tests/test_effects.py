@@ -0,0 +1,152 @@
+import numpy as np
+import pytest
+from animusic import effects
+
+
+def reference_sin_wave_distortion(img, signal, mag=10, freq=20):
+    """The original np.roll implementation of sin_wave_distortion."""
+    img = img.copy()
+    phase = -2 * np.pi * signal
+    mag = mag * signal
+    height = img.shape[0]
+    offsets = (mag * np.sin(2 * np.pi * freq * (np.arange(height) / height) + phase)).astype(int)
+    for offset in np.unique(offsets):
+        idx = (offsets==offset)
+        img[idx] = np.roll(img[idx], offset, axis=1)
+    return img
+
+
+def reference_chromatic_aberration(img, signal, mag=10):
+    """The original np.roll implementation of chromatic_aberration."""
+    img = img.copy()
+    offset = int(mag * signal)
+    img[:,:,0] = np.roll(img[:,:,0], -offset)
+    img[:,:,2] = np.roll(img[:,:,2], offset)
+    return img
+
+
+def reference_pixel_sort(img, signal, multiplier=2, reverse=True):
+    """The original pixel_sort: every run of masked pixels in a row sorted on its own.
+
+    The mask is Pillow's 'L' conversion and the sort key int() of the
+    Rec. 709 luminance, as in the original.
+    """
+    from PIL import Image
+    height, width = img.shape[:2]
+    lum = [[int(0.2126 * r + 0.7152 * g + 0.0722 * b) for r, g, b in row] for row in img[..., :3].tolist()]
+    lum_limit = multiplier * np.median(lum)
+    lum_limit = abs(lum_limit) if lum_limit <= 255 else 255
+    mask = np.array(Image.fromarray(np.ascontiguousarray(img)).convert('L')) < lum_limit * signal
+    out = img.copy()
+    for y in range(height):
+        x = 0
+        while x < width:
+            end = x
+            while end < width and mask[y, end]:
+                end += 1
+            if end > x:
+                run = sorted(range(x, end), key=lambda k: lum[y][k], reverse=reverse)
+                out[y, x:end] = img[y, run]
+            x = end + 1
+    return out
+
+
+def reference_noise_bands(img, signal, mag=5, min_luminosity=0, max_luminosity=0.75, seed=0):
+    """noise_bands with the rows of the bands collected one band at a time, drawing the same noise."""
+    out = img.copy()
+    count = int(mag * signal)
+    if count <= 0:
+        return out
+    height, width = img.shape[:2]
+    rng = np.random.default_rng([seed, int(round(signal * 2**24))])
+    tops = rng.integers(0, height, size=count)
+    bottoms = np.minimum(tops + rng.integers(1, max(2, count), size=count), height)
+    rows = sorted(set().union(*(range(top, bottom) for top, bottom in zip(tops, bottoms))))
+    noise = rng.integers(round(min_luminosity * 255), round(max_luminosity * 255) + 1, size=(len(rows), width, 1),
+                         dtype=np.uint16)
+    for row, row_noise in zip(rows, noise):
+        band = img[row, :, :3].astype(int)
+        out[row, :, :3] = (band + np.maximum(band, row_noise) + 1) // 2
+    return out
+
+
+def make_image(height, width, channels, contiguous=True, seed=0):
+    rng = np.random.default_rng(seed)
+    if contiguous:
+        return rng.integers(0, 256, size=(height, width, channels), dtype=np.uint8)
+    # Every other column of a wider image, so rows aren't contiguous
+    return rng.integers(0, 256, size=(height, 2 * width, channels), dtype=np.uint8)[:, ::2]
+
+
+IMAGES = [
+    (64, 96, 3, True),
+    (64, 96, 4, True),
+    (37, 53, 3, True),
+    (37, 53, 4, False),
+    (120, 81, 3, False),
+]
+SIGNALS = [0, 0.01, 0.25, 0.5, 0.999, 1, -0.7]
+
+
+@pytest.mark.parametrize('height, width, channels, contiguous', IMAGES)
+@pytest.mark.parametrize('signal', SIGNALS)
+@pytest.mark.parametrize('mag, freq', [(10, 20), (3, 1), (40, 7), (200, 33)])
+def test_sin_wave_distortion_matches_reference(height, width, channels, contiguous, signal, mag, freq):
+    img = make_image(height, width, channels, contiguous)
+    expected = reference_sin_wave_distortion(img, signal, mag=mag, freq=freq)
+    assert np.array_equal(effects.sin_wave_distortion(img, signal, mag=mag, freq=freq), expected)
+    out = np.empty((height, width, channels), dtype=np.uint8)
+    assert effects.sin_wave_distortion(img, signal, mag=mag, freq=freq, out=out) is out
+    assert np.array_equal(out, expected)
+
+
+@pytest.mark.parametrize('height, width, channels, contiguous', IMAGES)
+@pytest.mark.parametrize('signal', SIGNALS)
+@pytest.mark.parametrize('mag', [10, 1, 75, 10000])
+def test_chromatic_aberration_matches_reference(height, width, channels, contiguous, signal, mag):
+    img = make_image(height, width, channels, contiguous)
+    expected = reference_chromatic_aberration(img, signal, mag=mag)
+    assert np.array_equal(effects.chromatic_aberration(img, signal, mag=mag), expected)
+    out = np.empty((height, width, channels), dtype=np.uint8)
+    assert effects.chromatic_aberration(img, signal, mag=mag, out=out) is out
+    assert np.array_equal(out, expected)
+
+
+@pytest.mark.parametrize('height, width, channels, contiguous', IMAGES)
+@pytest.mark.parametrize('signal', SIGNALS)
+@pytest.mark.parametrize('multiplier, reverse', [(2, True), (2, False), (0.5, True), (5, True), (-3, False)])
+def test_pixel_sort_matches_per_run_reference(height, width, channels, contiguous, signal, multiplier, reverse):
+    pytest.importorskip('PIL')
+    img = make_image(height, width, channels, contiguous)
+    # Grey pixels, whose luminance float rounding can put just below an integer, and long dark runs
+    img[:4] = np.arange(width)[None, :, None] % 256
+    img[height // 2:, :width // 2, :3] //= 4
+    expected = reference_pixel_sort(img, signal, multiplier=multiplier, reverse=reverse)
+    assert np.array_equal(effects.pixel_sort(img, signal, multiplier=multiplier, reverse=reverse), expected)
+    out = np.empty((height, width, channels), dtype=np.uint8)
+    assert effects.pixel_sort(img, signal, multiplier=multiplier, reverse=reverse, out=out) is out
+    assert np.array_equal(out, expected)
+
+
+@pytest.mark.parametrize('height, width, channels, contiguous', IMAGES)
+@pytest.mark.parametrize('signal', SIGNALS)
+@pytest.mark.parametrize('mag, seed', [(5, 0), (20, 3), (1, 0)])
+def test_noise_bands_matches_per_band_reference(height, width, channels, contiguous, signal, mag, seed):
+    img = make_image(height, width, channels, contiguous)
+    expected = reference_noise_bands(img, signal, mag=mag, seed=seed)
+    assert np.array_equal(effects.noise_bands(img, signal, mag=mag, seed=seed), expected)
+    out = np.empty((height, width, channels), dtype=np.uint8)
+    assert effects.noise_bands(img, signal, mag=mag, seed=seed, out=out) is out
+    assert np.array_equal(out, expected)
+
+
+def test_noise_bands_only_lightens_whole_rows():
+    img = make_image(120, 81, 4)
+    result = effects.noise_bands(img, 1, mag=20)
+    changed = np.flatnonzero((result != img).any(axis=(1, 2)))
+    assert 0 < len(changed) < 120
+    assert np.array_equal(result[..., 3], img[..., 3])
+    assert np.all(result[..., :3] >= img[..., :3])
+    # A frame only depends on its signal and seed
+    assert np.array_equal(effects.noise_bands(img, 1, mag=20), result)
+    assert not np.array_equal(effects.noise_bands(img, 1, mag=20, seed=1), result)
@@ -0,0 +1,68 @@
+import collections
+import numpy as np
+import pytest
+
+pytest.importorskip('PIL')
+pytest.importorskip('moviepy')
+from animusic import effects
+from animusic.pipeline import EffectChain
+from animusic.render import render_frames
+
+
+class RampSignals:
+    """Signals cycling through 0-1 over frames, zero every fifth frame."""
+
+    def at_frame(self, band, i):
+        return 0 if i % 5 == 0 else (i * (0.13 if band == 'low' else 0.29)) % 1
+
+
+class HoldingWriter:
+    """Keep up to `hold` frames before releasing them, like FanoutWriter's queues.
+
+    Checks that no frame is modified while it's held.
+    """
+
+    def __init__(self, hold):
+        self.hold = hold
+        self.held = collections.deque()
+        self.frames = []
+        self.buffers = set()
+
+    def write_frame(self, frame, release=None):
+        self.frames.append(frame.copy())
+        self.buffers.add(id(frame))
+        self.held.append((frame, frame.copy(), release))
+        while len(self.held) > self.hold:
+            self.release()
+
+    def release(self):
+        frame, expected, release = self.held.popleft()
+        assert np.array_equal(frame, expected), 'frame modified before it was released'
+        release(frame)
+
+
+EFFECTS = [
+    (effects.sin_wave_distortion, 'low'),
+    (effects.chromatic_aberration, 'high'),
+    (effects.zoom, 'low'),
+]
+
+
+@pytest.mark.parametrize('workers, queue_size, hold', [(1, 8, 0), (4, 8, 0), (4, 2, 5), (3, 4, 12)])
+@pytest.mark.parametrize('effect_list', [EFFECTS, []])
+def test_render_frames_reuses_output_buffers_once_released(workers, queue_size, hold, effect_list):
+    rng = np.random.default_rng(0)
+    sources = [rng.integers(0, 256, (36, 48, 3), dtype=np.uint8) for _ in range(40)]
+    reference = EffectChain(effect_list, RampSignals())
+    expected = [reference.apply(frame, i).copy() for i, frame in enumerate(sources)]
+
+    writer = HoldingWriter(hold)
+    render_frames(writer, EffectChain(effect_list, RampSignals()), sources, workers=workers, queue_size=queue_size)
+    while writer.held:
+        writer.release()
+
+    assert len(writer.frames) == len(expected)
+    for frame, reference_frame in zip(writer.frames, expected):
+        assert np.array_equal(frame, reference_frame)
+    # Only the frames in flight are ever allocated
+    assert len(writer.buffers) <= queue_size + workers + hold + 2
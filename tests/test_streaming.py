@@ -0,0 +1,47 @@
+import threading
+import numpy as np
+import pytest
+
+soundfile = pytest.importorskip('soundfile')
+Image = pytest.importorskip('PIL.Image')
+ffmpeg_reader = pytest.importorskip('moviepy.video.io.ffmpeg_reader')
+from animusic.streaming import stream_animation
+
+
+@pytest.fixture
+def media(tmp_path):
+    """Write a short beat-like stereo WAV and a small image, returning their paths."""
+    sr = 44100
+    t = np.arange(2 * sr) / sr
+    kick = np.sin(2 * np.pi * 60 * t) * np.exp(-20 * (t % 0.5))
+    hats = np.random.default_rng(0).standard_normal(t.size) * np.exp(-60 * ((t + 0.25) % 0.5))
+    y = 0.4 * np.stack([kick + 0.2 * hats, kick - 0.2 * hats], axis=1)
+    audio = str(tmp_path / 'beat.wav')
+    soundfile.write(audio, y.astype(np.float32), sr)
+    img = str(tmp_path / 'image.png')
+    Image.fromarray(np.random.default_rng(1).integers(0, 256, (121, 161, 3), dtype=np.uint8)).save(img)
+    return img, audio
+
+
+def test_stream_animation_to_a_file_exits_with_video_and_audio(media, tmp_path):
+    img, audio = media
+    output = str(tmp_path / 'stream.mp4')
+    errors = []
+
+    def stream():
+        try:
+            stream_animation(img, audio, output, realtime=False)
+        except Exception as e:
+            errors.append(e)
+
+    # A deadlocked stream would never return, so fail after a timeout instead of hanging
+    thread = threading.Thread(target=stream, daemon=True)
+    thread.start()
+    thread.join(60)
+    assert not thread.is_alive(), 'stream_animation did not finish'
+    assert not errors, errors
+
+    infos = ffmpeg_reader.ffmpeg_parse_infos(output)
+    assert infos['video_found'] and infos['audio_found']
+    assert infos['video_size'] == [160, 120]
+    assert infos['duration'] == pytest.approx(2, abs=0.1)